@@ -1,40 +1,141 @@
 import json
+import time
 import urllib.parse
 import urllib.request
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 class ArchiveAPI:
 
+    ARCHIVE_URL = "https://web.archive.org"
+    SNAPSHOT_FIELDS = ("timestamp", "original", "digest", "length")
+
+    def cdx_request_url(self, url, params):
+        request_url = urllib.parse.urljoin(self.archive_url, '/cdx/search/xd')
+        params = [("output", "json"), ("url", url)] + params
+        return urllib.parse.urljoin(request_url, '?' + urllib.parse.urlencode(params))
+
     def get_raw_list_from_api(self, url, page_index):
-        request_url = urllib.parse.urlunparse(('https', 'web.archive.org', '/cdx/search/xd', '', '', ''))
-        params = [("output", "json"), ("url", url)]
-        params += self.parameters_for_api(page_index)
-        request_url = urllib.parse.urljoin(request_url, '?' + urllib.parse.urlencode(params))
+        return self.scheduler.call(lambda: self.fetch_raw_list_from_api(url, page_index), url)
 
-        try:
-            with urllib.request.urlopen(request_url) as response:
+    def fetch_raw_list_from_api(self, url, page_index):
+        start = time.perf_counter()
+        snapshot_list = list(self.iter_raw_list_from_api(url, page_index))
+        self.stats.request('cdx', time.perf_counter() - start, 200)
+        self.stats.count('cdx_rows', len(snapshot_list))
+        return snapshot_list
+
+    def iter_raw_list_from_api(self, url, page_index):
+        request_url = self.cdx_request_url(url, self.parameters_for_api(page_index))
+
+        fields_count = len(self.SNAPSHOT_FIELDS)
+        with urllib.request.urlopen(request_url, timeout=self.scheduler.timeout) as response:
+            rows = self.parse_cdx_lines(response)
+            for row in rows:
+                if row[:fields_count] != list(self.SNAPSHOT_FIELDS):
+                    yield self.collapsed_row(row) if self.collapse_urls() else row
+                break
+            for row in rows:
+                yield self.collapsed_row(row) if self.collapse_urls() else row
+
+    def collapse_urls(self):
+        return self.server_collapse and not self.all_timestamps
+
+    def collapsed_row(self, row):
+        # With lastSkipTimestamp the server appends the timestamp of the newest
+        # capture folded into the row, which is the one worth downloading.
+        snapshot = row[:len(self.SNAPSHOT_FIELDS)]
+        last_skip_timestamp = row[-1]
+        if len(row) > len(snapshot) and last_skip_timestamp.isdigit() and last_skip_timestamp > snapshot[0]:
+            # The digest column still describes the first capture
+            snapshot[0] = last_skip_timestamp
+            snapshot[2] = '-'
+        return snapshot
+
+    def parse_cdx_lines(self, lines):
+        # The CDX server writes one snapshot row per line, so each line can be
+        # decoded on its own instead of buffering the whole page.
+        for line in lines:
+            line = line.strip()
+            if line.startswith(b'[['):
+                line = line[1:]
+            if line.endswith(b']]'):
+                line = line[:-1]
+            line = line.rstrip(b',')
+            if line in (b'', b'[', b']'):
+                continue
+            try:
+                rows = json.loads(b'[' + line + b']')
+            except json.JSONDecodeError:
+                # The rest of the page is lost
+                self.listing_complete = False
+                return
+            for row in rows:
+                if row:
+                    yield row
+
+    def get_pages_count(self, url):
+        params = self.parameters_for_api(None) + [("showNumPages", "true")]
+        request_url = self.cdx_request_url(url, params)
+
+        def read_pages_count():
+            start = time.perf_counter()
+            with urllib.request.urlopen(request_url, timeout=self.scheduler.timeout) as response:
                 content = response.read()
-            json_data = json.loads(content)
+            self.stats.request('cdx', time.perf_counter() - start, 200)
+            return content
+
+        try:
+            return int(self.scheduler.call(read_pages_count, url).strip())
+        except ValueError:
+            return None
 
-            if json_data[0] == ["timestamp", "original"]:
-                json_data.pop(0)
+    def iter_pages_from_api(self, url, pages_count):
+        # Pages are fetched ahead in a bounded window but handed out in order,
+        # so the caller can start consuming rows while later pages are in flight.
+        window = max(1, self.cdx_concurrency)
+        with ThreadPoolExecutor(max_workers=window) as executor:
+            pending = deque()
+            page_indexes = iter(range(pages_count))
+            for page_index in page_indexes:
+                pending.append(executor.submit(self.get_raw_list_from_api, url, page_index))
+                if len(pending) >= window:
+                    break
+            while pending:
+                snapshot_list = pending.popleft().result()
+                next_page_index = next(page_indexes, None)
+                if next_page_index is not None:
+                    pending.append(executor.submit(self.get_raw_list_from_api, url, next_page_index))
+                yield snapshot_list
 
-            return json_data
-        except json.JSONDecodeError:
-            return []
+    def snapshot_path(self, planned_file):
+        return urllib.parse.quote(f"/web/{planned_file.timestamp}id_/{planned_file.file_url}", safe="/:?&=%#;@+,$!~*'()[]")
+
+    def snapshot_url(self, planned_file):
+        return urllib.parse.urljoin(self.archive_url, self.snapshot_path(planned_file))
 
     def parameters_for_api(self, page_index):
-        parameters = [("fl", "timestamp,original"), ("collapse", "digest"), ("gzip", "false")]
+        parameters = [("fl", ",".join(self.SNAPSHOT_FIELDS))]
+
+        if self.collapse_urls():
+            parameters += [("collapse", "urlkey"), ("showSkipCount", "true"), ("lastSkipTimestamp", "true")]
+        else:
+            parameters.append(("collapse", "digest"))
+
+        parameters.append(("gzip", "false"))
 
         if not self.all:
             parameters.append(("filter", "statuscode:200"))
 
-        if self.from_timestamp and self.from_timestamp != 0:
+        if self.last_indexed_timestamp and int(self.last_indexed_timestamp) > self.from_timestamp:
+            parameters.append(("from", str(self.last_indexed_timestamp)))
+        elif self.from_timestamp and self.from_timestamp != 0:
             parameters.append(("from", str(self.from_timestamp)))
 
         if self.to_timestamp and self.to_timestamp != 0:
             parameters.append(("to", str(self.to_timestamp)))
 
-        if page_index:
+        if page_index is not None:
             parameters.append(("page", page_index))
 
         return parameters
@@ -0,0 +1,259 @@
+import asyncio
+import ssl
+import time
+import urllib.parse
+from http import HTTPStatus
+
+class HTTPResponseError(Exception):
+
+    def __init__(self, status, reason, headers=None, body=b''):
+        super().__init__(f"HTTP Error {status}: {reason}")
+        self.status = status
+        self.reason = reason
+        self.headers = headers or {}
+        self.body = body
+
+
+class ContentRangeError(ConnectionError):
+
+    # A 206 answer that doesn't start where the .part file ends. Nothing of
+    # its body is kept, so the request is retried from scratch rather than
+    # on another connection with the same Range.
+
+    body_started = True
+
+
+class HTTPConnectionPool:
+
+    def __init__(self, archive_url, size, timeout=None):
+        parsed_url = urllib.parse.urlsplit(archive_url)
+        self.host = parsed_url.hostname
+        self.https = parsed_url.scheme == 'https'
+        self.port = parsed_url.port or (443 if self.https else 80)
+        self.host_header = parsed_url.netloc
+        self.ssl_context = ssl.create_default_context() if self.https else None
+        self.size = size
+        self.timeout = timeout
+        self.idle = []
+        self.slots = asyncio.Semaphore(size)
+
+    async def acquire(self):
+        await self.slots.acquire()
+        if self.idle:
+            return self.idle.pop(), True
+        try:
+            connection = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port, ssl=self.ssl_context, limit=2 ** 20), self.timeout)
+        except BaseException:
+            self.slots.release()
+            raise
+        return connection, False
+
+    def release(self, connection, reusable):
+        if reusable:
+            self.idle.append(connection)
+        else:
+            connection[1].close()
+        self.slots.release()
+
+    async def close(self):
+        while self.idle:
+            _, writer = self.idle.pop()
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    async def get(self, path, sink, headers=None):
+        # A connection sitting idle in the pool may have been closed by the
+        # server in the meantime; that only shows up on the next request.
+        for attempt in range(2):
+            connection, reused = await self.acquire()
+            reusable = False
+            try:
+                status, response_headers, reusable = await self.request(connection, path, sink, headers or {})
+                return status, response_headers
+            except (ConnectionError, asyncio.IncompleteReadError) as e:
+                if not reused or attempt == 1 or getattr(e, 'body_started', False):
+                    raise
+            finally:
+                self.release(connection, reusable)
+
+    async def request(self, connection, path, sink, headers):
+        reader, writer = connection
+        request_lines = [f"GET {path} HTTP/1.1", f"Host: {self.host_header}",
+                         "Accept-Encoding: identity", "Connection: keep-alive"]
+        request_lines += [f"{name}: {value}" for name, value in headers.items()]
+        writer.write(("\r\n".join(request_lines) + "\r\n\r\n").encode('latin-1'))
+        await self.timed(writer.drain())
+
+        status_line = await self.timed(reader.readline())
+        if not status_line:
+            raise ConnectionResetError("Connection closed by the archive")
+        _, status, *_ = status_line.decode('latin-1').split(' ', 2)
+        status = int(status)
+        response_headers = {}
+        while True:
+            line = await self.timed(reader.readline())
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            response_headers[name.strip().lower()] = value.strip()
+
+        reusable = response_headers.get('connection', '').lower() != 'close'
+        body_sink = sink(status, response_headers)
+        try:
+            if response_headers.get('transfer-encoding', '').lower() == 'chunked':
+                await self.read_chunked(reader, body_sink)
+            elif 'content-length' in response_headers:
+                await self.read_length(reader, int(response_headers['content-length']), body_sink)
+            else:
+                await self.read_until_close(reader, body_sink)
+                reusable = False
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            e.body_started = True
+            raise
+        return status, response_headers, reusable
+
+    async def timed(self, awaitable):
+        # The timeout applies to every read, like a socket timeout, so a
+        # connection stalling mid-body fails instead of holding its slot.
+        return await asyncio.wait_for(awaitable, self.timeout)
+
+    async def read_length(self, reader, length, body_sink, chunk_size=2 ** 16):
+        while length > 0:
+            chunk = await self.timed(reader.read(min(chunk_size, length)))
+            if not chunk:
+                raise asyncio.IncompleteReadError(b'', length)
+            length -= len(chunk)
+            body_sink(chunk)
+
+    async def read_chunked(self, reader, body_sink):
+        while True:
+            size_line = await self.timed(reader.readline())
+            size = int(size_line.split(b';')[0].strip() or b'0', 16)
+            if size == 0:
+                while await self.timed(reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                return
+            await self.read_length(reader, size, body_sink)
+            await self.timed(reader.readexactly(2))
+
+    async def read_until_close(self, reader, body_sink, chunk_size=2 ** 16):
+        while chunk := await self.timed(reader.read(chunk_size)):
+            body_sink(chunk)
+
+
+class AsyncDownloadEngine:
+
+    MAXIMUM_REDIRECTS = 5
+
+    def __init__(self, downloader, concurrency, pool=None):
+        self.downloader = downloader
+        self.concurrency = max(1, concurrency)
+        self.pool = pool
+
+    def run(self):
+        asyncio.run(self.download_all())
+
+    async def download_all(self):
+        self.pool = HTTPConnectionPool(self.downloader.archive_url, self.concurrency, self.downloader.scheduler.timeout)
+        queue = self.downloader.file_queue
+        workers = [asyncio.create_task(self.download_file_worker(queue, worker)) for worker in range(self.concurrency)]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            await self.pool.close()
+
+    async def download_file_worker(self, queue, worker):
+        while (file_index := queue.get(worker)) is not None:
+            start = time.perf_counter()
+            await self.download_file(self.downloader.download_plan[file_index])
+            self.downloader.stats.worker_busy(worker, time.perf_counter() - start)
+
+    async def download_file(self, planned_file):
+        downloader = self.downloader
+        file_url = planned_file.file_url
+        file_path = planned_file.file_path
+
+        if downloader.already_downloaded(planned_file):
+            downloader.stats.count('files_existing')
+            downloader.count_processed_file(
+                f"{file_url} # {file_path} {'is up to date' if downloader.manifest else 'already exists'}.")
+            return
+        if downloader.link_stored_file(planned_file):
+            downloader.stats.count('files_linked')
+            downloader.count_processed_file(f"{file_url} -> {file_path} (linked)")
+            return
+
+        part_path = downloader.part_path(file_path)
+        offset = downloader.start_file(planned_file, part_path)
+        status = None
+        complete = False
+        try:
+            status = await downloader.scheduler.call_async(
+                lambda: self.fetch(downloader.snapshot_path(planned_file), part_path), file_url)
+            complete = True
+        except HTTPResponseError as e:
+            status = e.status
+            if status == 416 and offset:
+                complete = True
+            else:
+                print(f"{file_url} # {e}")
+                if downloader.all:
+                    with part_path.open("wb") as file:
+                        file.write(e.body)
+                    print(f"{file_path} saved anyway.")
+                    complete = True
+        except Exception as e:
+            print(f"{file_url} # {e}")
+        finally:
+            downloader.finish_file(planned_file, part_path, complete, status)
+        downloader.count_processed_file(f"{file_url} -> {file_path}")
+
+    async def fetch(self, path, part_path):
+        start = time.perf_counter()
+        offset = part_path.stat().st_size if part_path.exists() else 0
+        files = []
+        error_body = bytearray()
+
+        def sink(status, headers):
+            if status < 300:
+                files.append(self.downloader.open_part(part_path, status, offset, headers.get('content-range')))
+                return files[-1].write
+            if status >= 400 and self.downloader.all:
+                # Kept aside: the scheduler may still retry this status, and
+                # only the last attempt's body is saved
+                return error_body.extend
+            return lambda chunk: None
+
+        try:
+            for _ in range(self.MAXIMUM_REDIRECTS + 1):
+                status, headers = await self.pool.get(path, sink, self.downloader.range_headers(offset))
+                if 300 <= status < 400 and 'location' in headers:
+                    path = self.same_host_path(headers['location'])
+                    continue
+                if status >= 300:
+                    raise HTTPResponseError(status, self.reason(status), headers, bytes(error_body))
+                for file in files:
+                    file.close()
+                self.downloader.record_fetch(start, part_path, offset, status)
+                return status
+            raise HTTPResponseError(status, "Too many redirects")
+        finally:
+            for file in files:
+                file.close()
+
+    def same_host_path(self, location):
+        parsed_location = urllib.parse.urlsplit(location)
+        if parsed_location.netloc and parsed_location.netloc != self.pool.host_header:
+            raise HTTPResponseError(302, f"Redirected off the archive host to {location}")
+        return urllib.parse.urlunsplit(('', '', parsed_location.path, parsed_location.query, ''))
+
+    @staticmethod
+    def reason(status):
+        try:
+            return HTTPStatus(status).phrase
+        except ValueError:
+            return ''
@@ -0,0 +1,150 @@
+import asyncio
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from async_downloader import AsyncDownloadEngine, HTTPConnectionPool
+from download_stats import DownloadStats
+from request_scheduler import RequestScheduler
+from wayback_machine_downloader import WaybackMachineDownloader
+from work_queue import WorkQueue
+
+class BatchDownloader:
+
+    # Mirrors many sites in one process. Sites are listed a few at a time in
+    # threads, and their files feed a single work queue served by one pool
+    # of asyncio workers over one keep-alive connection pool to the archive.
+    # All requests share one scheduler, so retries, throttling and the rate
+    # limit apply to the batch as a whole; a per-site semaphore keeps any one
+    # site from taking every worker. Each site keeps its own counters for
+    # the per-site results, and adds them to the batch stats as it goes.
+
+    def __init__(self, sites, params):
+        self.concurrency = max(1, int(params.get('threads_count') or 1))
+        self.site_concurrency = max(1, int(params.get('site_concurrency') or self.concurrency))
+        self.listing_concurrency = max(1, int(params.get('listing_concurrency') or 4))
+        self.stats = DownloadStats()
+        self.stats_path = params.get('stats')
+        cdx_concurrency = int(params.get('cdx_concurrency') or 4)
+        self.scheduler = RequestScheduler(max(self.concurrency, self.listing_concurrency * cdx_concurrency),
+                                          rate_limit=params.get('rate_limit'),
+                                          retries=int(params.get('retries') if params.get('retries') is not None else 5),
+                                          stats=self.stats)
+        self.downloaders = []
+        for site in sites:
+            downloader = WaybackMachineDownloader({**params, 'base_url': site, 'engine': 'asyncio', 'stats': None,
+                                                   'progress_interval': None})
+            if params.get('directory'):
+                downloader.directory = os.path.join(params['directory'], downloader.backup_name())
+            downloader.scheduler = self.scheduler
+            downloader.stats = DownloadStats(self.stats)
+            self.downloaders.append(downloader)
+        self.results = [{'site': site, 'state': 'pending', 'files': 0} for site in sites]
+
+    @staticmethod
+    def read_sites(path):
+        file = sys.stdin if path == '-' else open(path)
+        try:
+            return [line.strip() for line in file if line.strip() and not line.lstrip().startswith('#')]
+        finally:
+            if file is not sys.stdin:
+                file.close()
+
+    def run(self):
+        start_time = time.time()
+        with self.stats.phase('download'):
+            asyncio.run(self.download_all())
+        print()
+        for result in self.results:
+            print(self.summary(result))
+        print(f"Batch completed in {round(time.time() - start_time, 2)}s ({len(self.results)} sites)")
+        if self.stats_path:
+            self.stats.write(self.stats_path, sites=self.results)
+
+    async def download_all(self):
+        self.pool = HTTPConnectionPool(self.downloaders[0].archive_url if self.downloaders else '',
+                                       self.concurrency, self.scheduler.timeout)
+        self.queue = WorkQueue(self.concurrency)
+        self.queued = asyncio.Event()
+        self.listings_pending = len(self.downloaders)
+        self.site_slots = [asyncio.Semaphore(self.site_concurrency) for _ in self.downloaders]
+        self.engines = [AsyncDownloadEngine(downloader, self.site_concurrency, self.pool)
+                        for downloader in self.downloaders]
+        self.stats.workers_count = self.concurrency
+        executor = ThreadPoolExecutor(self.listing_concurrency)
+        try:
+            listings = [asyncio.create_task(self.list_site(site_index, executor))
+                        for site_index in range(len(self.downloaders))]
+            workers = [asyncio.create_task(self.download_file_worker(worker)) for worker in range(self.concurrency)]
+            await asyncio.gather(*listings)
+            await asyncio.gather(*workers)
+            for downloader in self.downloaders:
+                if downloader.manifest:
+                    downloader.remove_stale_files()
+        finally:
+            executor.shutdown()
+            await self.pool.close()
+            for site_index, downloader in enumerate(self.downloaders):
+                downloader.finish_download()
+                self.record_result(site_index)
+
+    async def list_site(self, site_index, executor):
+        downloader = self.downloaders[site_index]
+        result = self.results[site_index]
+        start = time.perf_counter()
+        try:
+            ready = await asyncio.get_running_loop().run_in_executor(executor, downloader.start_download)
+        except Exception as e:
+            print(f"{downloader.base_url} # {e}")
+            result['state'] = 'failed'
+            result['error'] = str(e)
+            ready = False
+        else:
+            result['state'] = 'listed' if ready else 'empty'
+            result['files'] = len(downloader.download_plan)
+        result['listing_seconds'] = round(time.perf_counter() - start, 3)
+
+        if ready:
+            for file_index, file_record in enumerate(downloader.download_plan.file_list):
+                self.queue.put((site_index, file_index), WorkQueue.host(file_record.file_url),
+                               WorkQueue.priority(file_record))
+                if file_index % 10000 == 9999:
+                    # Let workers start on this site while the rest is queued
+                    self.queued.set()
+                    await asyncio.sleep(0)
+        self.listings_pending -= 1
+        self.queued.set()
+
+    async def download_file_worker(self, worker):
+        while True:
+            item = self.queue.get(worker)
+            if item is None:
+                if not self.listings_pending:
+                    return
+                self.queued.clear()
+                await self.queued.wait()
+                continue
+            site_index, file_index = item
+            downloader = self.downloaders[site_index]
+            start = time.perf_counter()
+            async with self.site_slots[site_index]:
+                await self.engines[site_index].download_file(downloader.download_plan[file_index])
+            self.stats.worker_busy(worker, time.perf_counter() - start)
+
+    def record_result(self, site_index):
+        result = self.results[site_index]
+        counters = self.downloaders[site_index].stats.counters
+        for name in ('files_done', 'files_existing', 'files_linked', 'files_failed'):
+            result[name] = counters.get(name, 0)
+        result['snapshot_bytes'] = counters.get('snapshot_bytes', 0)
+        if result['state'] == 'listed':
+            result['state'] = 'incomplete' if result['files_failed'] else 'done'
+
+    @staticmethod
+    def summary(result):
+        if result['state'] == 'failed':
+            return f"{result['site']}: listing failed ({result['error']})"
+        return (f"{result['site']}: {result['state']}, {result['files_done']} downloaded, "
+                f"{result['files_existing'] + result['files_linked']} already present, "
+                f"{result['files_failed']} failed ({result['files']} files)")
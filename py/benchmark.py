@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+
+# Offline benchmarks for the downloader, run against a local WaybackStub
+# serving a synthetic site. Each scenario runs in a fresh process so its
+# peak memory is its own and the stub's server threads don't share its GIL.
+
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from itertools import islice
+
+from wayback_stub import WaybackStub
+
+SCENARIOS = ('listing', 'download', 'filters', 'curation', 'tidy_bytes')
+EXTENSIONS = (('html', 40, 8 * 2 ** 10), ('css', 10, 4 * 2 ** 10), ('js', 10, 16 * 2 ** 10),
+              ('png', 25, 32 * 2 ** 10), ('jpg', 10, 64 * 2 ** 10), ('pdf', 5, 256 * 2 ** 10))
+BODIES_PER_EXTENSION = 16
+
+# Lower is better for every metric compared against a baseline; a run lists
+# the site once, so any extra CDX request is a regression
+COMPARED_METRICS = ('seconds', 'peak_rss_mib', 'cdx_requests')
+EXACT_METRICS = ('cdx_requests',)
+
+
+def synthetic_site(files_count, captures=2, seed=0, host='example.com'):
+    # Paths spread over a few directory levels, with extensions and sizes
+    # roughly like a small site; bodies come from a shared pool per extension
+    # so a million snapshots don't need a million bodies.
+    generator = random.Random(seed)
+    bodies = {extension: [bytes(generator.getrandbits(8) for _ in range(64)) * max(1, size // 64 + index)
+                          for index in range(BODIES_PER_EXTENSION)]
+              for extension, _, size in EXTENSIONS}
+    extensions = [extension for extension, _, _ in EXTENSIONS]
+    weights = [weight for _, weight, _ in EXTENSIONS]
+    for file_index in range(files_count):
+        extension = generator.choices(extensions, weights)[0]
+        depth = generator.randrange(4)
+        directories = ''.join(f"d{generator.randrange(32)}/" for _ in range(depth))
+        original = f"http://{host}/{directories}f{file_index}.{extension}"
+        for capture in range(generator.randint(1, captures)):
+            timestamp = 20100101000000 + capture * 10000000000 + generator.randrange(10 ** 6)
+            yield timestamp, original, generator.choice(bodies[extension])
+
+
+def peak_rss_mib():
+    # ru_maxrss survives fork and exec, so a child spawned from the process
+    # holding the stub would report the stub's size; VmHWM starts afresh.
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    # ru_maxrss is in KiB on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def downloader_for(options, archive_url, directory=None):
+    from wayback_machine_downloader import WaybackMachineDownloader
+    return WaybackMachineDownloader({
+        'base_url': 'http://example.com',
+        'directory': directory,
+        'archive_url': archive_url,
+        'threads_count': options['concurrency'],
+        'engine': options['engine'],
+        'server_collapse': options['server_collapse'],
+        'retries': 8,
+    })
+
+
+def run_listing(options, archive_url):
+    downloader = downloader_for(options, archive_url)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        files_count = len(downloader.download_plan)
+    return {'seconds': time.perf_counter() - start, 'files': files_count}
+
+
+def run_download(options, archive_url):
+    directory = tempfile.mkdtemp(prefix='wayback-benchmark-')
+    try:
+        downloader = downloader_for(options, archive_url, directory)
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            downloader.download_files()
+        seconds = time.perf_counter() - start
+        report = downloader.stats.report()
+        snapshot_bytes = report['counters'].get('snapshot_bytes', 0)
+        return {
+            'seconds': seconds,
+            'files': len(downloader.download_plan),
+            'files_per_second': round(len(downloader.download_plan) / seconds, 1),
+            'mib_per_second': round(snapshot_bytes / seconds / 2 ** 20, 2),
+            'retries': report['counters'].get('retries', 0),
+            'snapshot_p50_ms': report['latency'].get('snapshot', {}).get('p50_ms'),
+            'snapshot_p99_ms': report['latency'].get('snapshot', {}).get('p99_ms'),
+        }
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def synthetic_urls(urls_count, seed=0, host='example.com'):
+    # Urls shaped like synthetic_site's, drawn from small pools of directories
+    # and extensions so that millions of them are quick to make
+    generator = random.Random(seed)
+    extensions = generator.choices([extension for extension, _, _ in EXTENSIONS],
+                                   [weight for _, weight, _ in EXTENSIONS], k=4096)
+    directories = [''.join(f"d{generator.randrange(32)}/" for _ in range(generator.randrange(4))) for _ in range(4093)]
+    for index in range(urls_count):
+        yield f"http://{host}/{directories[index % 4093]}f{index}.{extensions[index % 4096]}"
+
+
+def run_filters(options, archive_url):
+    from url_filter import UrlFilter
+    from wayback_machine_downloader import WaybackMachineDownloader
+    patterns = ['/\\.(png|jpg)$/i', '/d1/', 'f99', '/^http:\\/\\/example\\.com\\/d2\\/d3\\//', 'pdf']
+    url_filter = UrlFilter(patterns)
+    file_urls = synthetic_urls(options['filter_urls'], options['seed'])
+    seconds = per_url_seconds = 0.0
+    urls_count = matched = 0
+    # Batches of the size the downloader filters at a time
+    while file_url_batch := list(islice(file_urls, WaybackMachineDownloader.FILTER_BATCH_SIZE)):
+        urls_count += len(file_url_batch)
+        start = time.perf_counter()
+        matched += sum(url_filter.match_batch(file_url_batch))
+        seconds += time.perf_counter() - start
+        # Reference: every pattern tried on every url in turn
+        start = time.perf_counter()
+        sum(1 for file_url in file_url_batch
+            if any(regex.search(file_url) for regex in url_filter.regexes)
+            or any(literal in file_url.lower() for literal in url_filter.literals))
+        per_url_seconds += time.perf_counter() - start
+    return {'seconds': seconds, 'per_url_seconds': per_url_seconds, 'urls': urls_count, 'matched': matched}
+
+
+def curate_columnar(rows):
+    from snapshot_store import CuratedFileList
+    curated = CuratedFileList()
+    for timestamp, file_url in rows:
+        curated.add_newest(file_url.split('/', 3)[-1], file_url, timestamp)
+    return curated.by_timestamp()
+
+
+def curate_dicts(rows):
+    # Reference: the dict of dicts CuratedFileList replaced
+    curated = {}
+    for timestamp, file_url in rows:
+        file_id = file_url.split('/', 3)[-1]
+        if file_id not in curated or not curated[file_id]['timestamp'] > timestamp:
+            curated[file_id] = {'file_url': file_url, 'timestamp': timestamp}
+    curated = sorted(curated.items(), key=lambda item: item[1]['timestamp'], reverse=True)
+    return [{**file_info, 'file_id': file_id} for file_id, file_info in curated]
+
+
+def measure_curation(curate, rows):
+    start = time.perf_counter()
+    curate(rows)
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    file_list = curate(rows)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, len(file_list), round(retained / 2 ** 20, 1), round(peak / 2 ** 20, 1)
+
+
+def run_curation(options, archive_url):
+    rows = [(str(timestamp), original)
+            for timestamp, original, _ in synthetic_site(options['files'], options['captures'], options['seed'])]
+    seconds, files_count, retained_mib, peak_mib = measure_curation(curate_columnar, rows)
+    dict_seconds, _, dict_retained_mib, dict_peak_mib = measure_curation(curate_dicts, rows)
+    return {'seconds': seconds, 'dict_seconds': dict_seconds, 'rows': len(rows), 'files': files_count,
+            'retained_mib': retained_mib, 'dict_retained_mib': dict_retained_mib,
+            'peak_mib': peak_mib, 'dict_peak_mib': dict_peak_mib}
+
+
+def tidy_bytes_per_byte(data):
+    # Reference: the per-byte algorithm tidy_bytes replaced, with its last
+    # pass fixed to leave ASCII and valid sequences alone
+    from tidy_bytes import tidy_byte
+    tidied = [[byte] for byte in data]
+    conts_expected = 0
+    last_lead = 0
+    for index, byte in enumerate(data):
+        if byte > 240:
+            tidied[index] = tidy_byte(byte)
+        elif 127 < byte < 192:
+            if conts_expected == 0:
+                tidied[index] = tidy_byte(byte)
+            else:
+                conts_expected -= 1
+        else:
+            if conts_expected > 0:
+                for lead_index in range(last_lead, index):
+                    tidied[lead_index] = tidy_byte(data[lead_index])
+                conts_expected = 0
+            if byte > 191:
+                if index == len(data) - 1:
+                    tidied[index] = tidy_byte(byte)
+                else:
+                    conts_expected = 1 if byte < 224 else 2 if byte < 240 else 3
+                    last_lead = index
+    return bytes(tidied_byte for tidied_bytes in tidied if tidied_bytes for tidied_byte in tidied_bytes).decode('utf-8', 'replace')
+
+
+def run_tidy_bytes(options, archive_url):
+    from tidy_bytes import tidy_bytes
+    generator = random.Random(options['seed'])
+    valid = ('Wayback Machine – “archived” ' * (2 ** 16)).encode('utf-8')
+    mixed = bytes(generator.choice(b'abc \x93\x94\xe9\xc3\xa9') for _ in range(2 ** 20))
+    result = {}
+    for name, tidy in (('', tidy_bytes), ('per_byte_', tidy_bytes_per_byte)):
+        seconds = 0.0
+        for input_name, data in (('valid', valid), ('mixed', mixed)):
+            start = time.perf_counter()
+            tidy(data)
+            input_seconds = time.perf_counter() - start
+            seconds += input_seconds
+            result[f"{name}{input_name}_mib_per_second"] = round(len(data) / input_seconds / 2 ** 20, 1)
+        result[f"{name}seconds"] = seconds
+    return result
+
+
+def scenario_process(name, options, archive_url, results):
+    result = globals()[f"run_{name}"](options, archive_url)
+    result['seconds'] = round(result['seconds'], 3)
+    for metric in ('per_url_seconds', 'dict_seconds', 'per_byte_seconds'):
+        if metric in result:
+            result[metric] = round(result[metric], 3)
+    result['peak_rss_mib'] = peak_rss_mib()
+    results.put(result)
+
+
+def run_scenario(name, options, stub):
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    before = dict(stub.request_counts)
+    process = context.Process(target=scenario_process, args=(name, options, stub.url, results))
+    process.start()
+    result = results.get()
+    process.join()
+    for kind, metric in (('cdx', 'cdx_requests'), ('web', 'web_requests'), ('errors', 'injected_errors')):
+        count = stub.request_counts.get(kind, 0) - before.get(kind, 0)
+        if count:
+            result[metric] = count
+    return result
+
+
+def regressions(results, baseline, tolerance):
+    found = []
+    for name, result in results.items():
+        for metric in COMPARED_METRICS:
+            previous = baseline.get(name, {}).get(metric)
+            current = result.get(metric)
+            allowed = 0 if metric in EXACT_METRICS else tolerance
+            if previous and current is not None and current > previous * (1 + allowed):
+                found.append(f"{name}.{metric}: {current} vs {previous}")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the downloader against a local Wayback Machine stand-in.")
+    parser.add_argument("scenarios", nargs="*",
+                        help=f"Scenarios to run (Default is all of {', '.join(SCENARIOS)})")
+    parser.add_argument("--files", type=int, default=10000, help="Files in the synthetic site (Default is 10000)")
+    parser.add_argument("--captures", type=int, default=2, help="Maximum snapshots per file (Default is 2)")
+    parser.add_argument("--filter-urls", type=int, default=5000000,
+                        help="Urls matched by the filters scenario, independent of --files (Default is 5000000)")
+    parser.add_argument("--page-size", type=int, default=5000, help="CDX rows per page (Default is 5000)")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every response")
+    parser.add_argument("--bandwidth", type=float, help="Bytes per second for each response body")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with 503")
+    parser.add_argument("-c", "--concurrency", type=int, default=16, help="Download concurrency (Default is 16)")
+    parser.add_argument("--engine", choices=["threads", "asyncio"], default="threads")
+    parser.add_argument("--server-collapse", action="store_true", help="List with server side collapsing")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", dest="json_path", help="Write the results as JSON to this path")
+    parser.add_argument("--compare", dest="baseline_path",
+                        help="Compare with a previous --json result and exit with 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Allowed slowdown against the baseline as a fraction (Default is 0.2)")
+    args = parser.parse_args()
+    unknown_scenarios = set(args.scenarios) - set(SCENARIOS)
+    if unknown_scenarios:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown_scenarios))}")
+    args.scenarios = args.scenarios or SCENARIOS
+    options = vars(args)
+
+    start = time.perf_counter()
+    snapshots = synthetic_site(args.files, args.captures, args.seed)
+    with WaybackStub(snapshots, page_size=args.page_size, latency=args.latency, bandwidth=args.bandwidth,
+                     error_rate=args.error_rate, seed=args.seed) as stub:
+        print(f"Serving {len(stub.snapshots)} snapshots of {args.files} files at {stub.url} "
+              f"({round(time.perf_counter() - start, 1)}s to build)", file=sys.stderr)
+        results = {}
+        for name in args.scenarios:
+            results[name] = run_scenario(name, options, stub)
+            print(f"{name}: {json.dumps(results[name])}")
+
+    if args.json_path:
+        with open(args.json_path, 'w') as file:
+            json.dump(results, file, indent=2)
+            file.write('\n')
+    if args.baseline_path:
+        with open(args.baseline_path) as file:
+            found = regressions(results, json.load(file), args.tolerance)
+        for regression in found:
+            print(f"Regression: {regression}", file=sys.stderr)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+import os
+import shutil
+from pathlib import Path
+
+class ContentStore:
+
+    # Bodies are kept once under objects/<first two chars>/<digest>, and every
+    # snapshot path holding the same bytes is a hard link to that object.
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def object_path(self, digest):
+        return self.path / digest[:2] / digest
+
+    @staticmethod
+    def usable(digest):
+        return bool(digest) and digest.isalnum()
+
+    def has(self, digest):
+        return self.usable(digest) and self.object_path(digest).exists()
+
+    def link(self, digest, file_path):
+        self.materialize(self.object_path(digest), file_path)
+
+    def add(self, digest, file_path):
+        if not self.usable(digest):
+            return
+        object_path = self.object_path(digest)
+        object_path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            self.materialize(file_path, object_path)
+        except FileExistsError:
+            pass
+
+    @staticmethod
+    def materialize(source_path, target_path):
+        # Hard links need both paths on one filesystem; fall back to a copy
+        try:
+            os.link(source_path, target_path)
+        except FileExistsError:
+            raise
+        except OSError:
+            shutil.copyfile(source_path, target_path)
@@ -0,0 +1,86 @@
+import json
+import os
+import time
+from pathlib import Path
+from threading import Lock
+
+class DownloadJournal:
+
+    PENDING = 'pending'
+    IN_PROGRESS = 'in-progress'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.entries = {}
+        self.lock = Lock()
+        lines_count = self.load()
+        if lines_count > 2 * len(self.entries) + 1000:
+            self.compact()
+        self.file = self.path.open('a', encoding='utf-8')
+        if self.torn:
+            self.file.write('\n')
+
+    def load(self):
+        lines_count = 0
+        self.torn = False
+        if not self.path.exists():
+            return lines_count
+        with self.path.open(encoding='utf-8') as file:
+            for line in file:
+                lines_count += 1
+                self.torn = not line.endswith('\n')
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # A run killed mid-write leaves at most one torn line behind
+                    continue
+                self.entries[entry['file_id']] = entry
+        return lines_count
+
+    def compact(self):
+        temporary_path = self.path.with_name(self.path.name + '.temp')
+        with temporary_path.open('w', encoding='utf-8') as file:
+            for entry in self.entries.values():
+                file.write(json.dumps(entry) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, self.path)
+        self.torn = False
+
+    def close(self):
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def record(self, planned_file, state, **fields):
+        entry = {'file_id': planned_file.file_id, 'file_url': planned_file.file_url,
+                 'timestamp': planned_file.timestamp, 'state': state, 'time': int(time.time()), **fields}
+        line = json.dumps(entry) + '\n'
+        with self.lock:
+            self.entries[planned_file.file_id] = entry
+            self.file.write(line)
+            self.file.flush()
+
+    def state(self, file_id):
+        entry = self.entries.get(file_id)
+        return entry['state'] if entry else self.PENDING
+
+    def is_done(self, file_id):
+        return self.state(file_id) == self.DONE
+
+    def resumable(self, planned_file):
+        # A .part file only belongs to this snapshot if the run that left it
+        # was fetching the same timestamp.
+        entry = self.entries.get(planned_file.file_id)
+        return (bool(entry) and entry['state'] in (self.IN_PROGRESS, self.FAILED)
+                and entry['timestamp'] == planned_file.timestamp)
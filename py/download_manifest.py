@@ -0,0 +1,38 @@
+import json
+
+from download_journal import DownloadJournal
+
+class DownloadManifest(DownloadJournal):
+
+    # Sidecar record of which snapshot every file of the backup came from,
+    # kept with the journal's append-and-compact format. A refresh only
+    # fetches files whose newest snapshot no longer matches it.
+
+    REMOVED = 'removed'
+
+    def load(self):
+        lines_count = super().load()
+        self.entries = {file_id: entry for file_id, entry in self.entries.items() if entry['state'] != self.REMOVED}
+        return lines_count
+
+    def is_current(self, planned_file):
+        # A newer capture with the same digest has the same bytes. Collapsed
+        # CDX rows carry no usable digest, so the timestamp decides then.
+        entry = self.entries.get(planned_file.file_id)
+        if not entry or entry['state'] != self.DONE:
+            return False
+        digests = (entry.get('digest'), planned_file.digest)
+        if all(digest and digest != '-' for digest in digests):
+            return digests[0] == digests[1]
+        return entry['timestamp'] == planned_file.timestamp
+
+    def is_recorded(self, planned_file):
+        entry = self.entries.get(planned_file.file_id)
+        return bool(entry) and entry['timestamp'] == planned_file.timestamp
+
+    def remove(self, file_id):
+        line = json.dumps({'file_id': file_id, 'state': self.REMOVED}) + '\n'
+        with self.lock:
+            self.entries.pop(file_id, None)
+            self.file.write(line)
+            self.file.flush()
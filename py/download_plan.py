@@ -0,0 +1,67 @@
+from collections import namedtuple
+from pathlib import Path
+
+PlannedFile = namedtuple('PlannedFile', ['file_url', 'timestamp', 'file_id', 'dir_path', 'file_path', 'digest'])
+
+class DownloadPlan:
+
+    # Planned files are built on access from the compact file list, so the
+    # plan itself holds no per-file objects.
+
+    __slots__ = ('backup_path', 'file_list', '_directories')
+
+    def __init__(self, backup_path, file_list):
+        self.backup_path = Path(backup_path)
+        self.file_list = file_list
+
+    def __len__(self):
+        return len(self.file_list)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __getitem__(self, index):
+        return self.plan_file(self.file_list[index])
+
+    def plan_file(self, file_record):
+        dir_path, file_path = self.target_paths(file_record.file_url, file_record.file_id)
+        return PlannedFile(file_record.file_url, file_record.timestamp, file_record.file_id, dir_path, file_path,
+                           file_record.digest)
+
+    @property
+    def directories(self):
+        # Every directory of the output tree relative to the backup path,
+        # computed once from the whole file list so conflicts are settled
+        # before anything touches the disk.
+        if not hasattr(self, "_directories"):
+            self._directories = set()
+            for file_record in self.file_list:
+                dir_elements, _ = self.target_elements(file_record.file_url, file_record.file_id)
+                while dir_elements:
+                    directory = '/'.join(dir_elements)
+                    if directory in self._directories:
+                        break
+                    self._directories.add(directory)
+                    dir_elements = dir_elements[:-1]
+        return self._directories
+
+    def target_paths(self, file_url, file_id):
+        dir_elements, file_name = self.target_elements(file_url, file_id)
+        if '/'.join(dir_elements + (file_name,)) in self.directories:
+            # Other files live below this one, so it becomes that directory's index
+            dir_elements += (file_name,)
+            file_name = 'index.html'
+        dir_path = self.backup_path.joinpath(*dir_elements)
+        return dir_path, dir_path / file_name
+
+    @staticmethod
+    def target_elements(file_url, file_id):
+        file_path_elements = file_id.split('/')
+
+        if file_id == "":
+            return (), 'index.html'
+        elif file_url[-1] == '/' or '.' not in file_path_elements[-1]:
+            return tuple(element for element in file_path_elements if element), 'index.html'
+        else:
+            return tuple(element for element in file_path_elements[:-1] if element), file_path_elements[-1]
@@ -0,0 +1,87 @@
+import zlib
+from collections import Counter
+
+from download_journal import DownloadJournal
+
+# A site's download plan split into shards by a stable hash of the file id,
+# so separate processes or machines can each take one shard of the same
+# plan and write into a shared backup directory.
+
+def parse_shard(value):
+    # "K/N" with K counted from 1, returned as a zero based (index, count)
+    try:
+        number, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise ValueError(f"invalid shard {value!r}, expected K/N such as 1/4")
+    if not 0 < number <= count:
+        raise ValueError(f"invalid shard {value!r}, K must be between 1 and N")
+    return number - 1, count
+
+
+def shard_of(file_id, shards_count):
+    # crc32 rather than hash() so every process agrees on the split
+    return zlib.crc32(file_id.encode('utf-8', 'surrogatepass')) % shards_count
+
+
+class ShardVerifier:
+
+    # Checks the whole plan against the journals every shard left behind,
+    # then merges them into the unsharded journal so a plain --journal run
+    # retries only what is missing.
+
+    def __init__(self, downloader):
+        self.downloader = downloader
+        self.state_path = downloader.state_path()
+
+    def journal_paths(self):
+        return sorted(self.state_path.glob('journal*.jsonl'))
+
+    def load_entries(self):
+        entries = {}
+        for path in self.journal_paths():
+            journal = DownloadJournal(path)
+            journal.close()
+            for file_id, entry in journal.entries.items():
+                previous = entries.get(file_id)
+                if previous is None or self.preferred(entry, previous):
+                    entries[file_id] = entry
+        return entries
+
+    @staticmethod
+    def preferred(entry, previous):
+        done, previous_done = entry['state'] == DownloadJournal.DONE, previous['state'] == DownloadJournal.DONE
+        if done != previous_done:
+            return done
+        return entry.get('time', 0) >= previous.get('time', 0)
+
+    def verify(self):
+        entries = self.load_entries()
+        results = Counter()
+        for planned_file in self.downloader.download_plan:
+            problem = self.problem(planned_file, entries.get(planned_file.file_id))
+            results[problem or 'ok'] += 1
+            if problem:
+                print(f"{planned_file.file_url} -> {planned_file.file_path} # {problem}")
+                if planned_file.file_id in entries:
+                    # So that the next --journal run fetches it again
+                    entries[planned_file.file_id] = {**entries[planned_file.file_id],
+                                                     'state': DownloadJournal.FAILED, 'problem': problem}
+        self.merge(entries)
+        return results
+
+    @staticmethod
+    def problem(planned_file, entry):
+        if entry is None:
+            return 'missing'
+        if entry['state'] != DownloadJournal.DONE:
+            return entry['state']
+        if not planned_file.file_path.exists():
+            return 'lost'
+        if 'bytes' in entry and planned_file.file_path.stat().st_size != entry['bytes']:
+            return 'size mismatch'
+        return None
+
+    def merge(self, entries):
+        with DownloadJournal(self.state_path / 'journal.jsonl') as journal:
+            journal.entries = entries
+            journal.compact()
@@ -0,0 +1,196 @@
+import json
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+class LatencyHistogram:
+
+    # Fixed millisecond buckets keep recording O(1) and the report small;
+    # percentiles are read back as the upper bound of their bucket.
+
+    BOUNDS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def add(self, seconds):
+        milliseconds = seconds * 1000
+        self.counts[bisect_left(self.BOUNDS, milliseconds)] += 1
+        self.count += 1
+        self.total += milliseconds
+        self.maximum = max(self.maximum, milliseconds)
+
+    def percentile(self, fraction):
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.BOUNDS[index] if index < len(self.BOUNDS) else round(self.maximum, 1)
+        return round(self.maximum, 1)
+
+    def to_dict(self):
+        buckets = {f"<={bound}": count for bound, count in zip(self.BOUNDS, self.counts) if count}
+        if self.counts[-1]:
+            buckets[f">{self.BOUNDS[-1]}"] = self.counts[-1]
+        return {
+            'count': self.count,
+            'mean_ms': round(self.total / self.count, 1) if self.count else None,
+            'p50_ms': self.percentile(0.5),
+            'p90_ms': self.percentile(0.9),
+            'p99_ms': self.percentile(0.99),
+            'max_ms': round(self.maximum, 1),
+            'buckets_ms': buckets,
+        }
+
+
+class DownloadStats:
+
+    # Collected from every worker thread, so all updates go through one lock.
+    # Phase timings are wall-clock and may overlap: listing runs inside
+    # planning because curation consumes the CDX pages as they arrive.
+    # With a parent (one site of a batch) every count, request, failure and
+    # phase time is added to the parent as well.
+
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.phases = defaultdict(float)
+        self.counters = Counter()
+        self.statuses = Counter()
+        self.latencies = defaultdict(LatencyHistogram)
+        self.busy = defaultdict(float)
+        self.workers_count = 0
+        self.queue_depths = []
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            self.phases[name] += seconds
+        if self.parent:
+            self.parent.add_time(name, seconds)
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+        if self.parent:
+            self.parent.count(name, amount)
+
+    def request(self, kind, seconds, status=None, size=0):
+        with self.lock:
+            self.latencies[kind].add(seconds)
+            self.counters[f"{kind}_requests"] += 1
+            if size:
+                self.counters[f"{kind}_bytes"] += size
+            if status is not None:
+                self.statuses[str(status)] += 1
+        if self.parent:
+            self.parent.request(kind, seconds, status, size)
+
+    def failure(self, status, retrying):
+        with self.lock:
+            self.counters['retries' if retrying else 'request_errors'] += 1
+            if status is not None:
+                self.statuses[str(status)] += 1
+        if self.parent:
+            self.parent.failure(status, retrying)
+
+    def worker_busy(self, worker, seconds):
+        with self.lock:
+            self.busy[worker] += seconds
+
+    def sample_queue(self, depth):
+        with self.lock:
+            self.queue_depths.append(depth)
+
+    def report(self):
+        with self.lock:
+            download_time = self.phases.get('download', 0.0)
+            snapshot_bytes = self.counters.get('snapshot_bytes', 0)
+            capacity = download_time * self.workers_count
+            return {
+                'started_at': self.started_at,
+                'elapsed_s': round(time.time() - self.started_at, 3),
+                'phases_s': {name: round(seconds, 3) for name, seconds in self.phases.items()},
+                'counters': dict(self.counters),
+                'statuses': dict(self.statuses),
+                'bytes_per_second': round(snapshot_bytes / download_time, 1) if download_time else None,
+                'latency': {kind: histogram.to_dict() for kind, histogram in self.latencies.items()},
+                'workers': self.workers_count,
+                'worker_utilization': round(sum(self.busy.values()) / capacity, 3) if capacity else None,
+                'queue_depth': {
+                    'samples': len(self.queue_depths),
+                    'max': max(self.queue_depths, default=0),
+                    'mean': round(sum(self.queue_depths) / len(self.queue_depths), 1) if self.queue_depths else 0,
+                },
+            }
+
+    def write(self, path, **sections):
+        report = json.dumps({**self.report(), **sections}, indent=2)
+        if path == '-':
+            # stdout carries the per-file lines
+            print(report, file=sys.stderr)
+        else:
+            with open(path, 'w') as file:
+                file.write(report + '\n')
+
+
+class ProgressReporter:
+
+    # Samples the queue depth every interval from a daemon thread until
+    # stopped, printing a progress line each time when asked to.
+
+    def __init__(self, downloader, interval, printing=True):
+        self.downloader = downloader
+        self.interval = interval
+        self.printing = printing
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.last_bytes = 0
+        self.last_time = time.perf_counter()
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    def report(self):
+        downloader = self.downloader
+        stats = downloader.stats
+        depth = len(downloader.file_queue)
+        stats.sample_queue(depth)
+        if not self.printing:
+            return
+        with stats.lock:
+            snapshot_bytes = stats.counters.get('snapshot_bytes', 0)
+            retries = stats.counters.get('retries', 0)
+            in_flight = downloader.scheduler.in_flight
+        now = time.perf_counter()
+        rate = (snapshot_bytes - self.last_bytes) / (now - self.last_time)
+        self.last_bytes, self.last_time = snapshot_bytes, now
+        print(f"[progress] {downloader.processed_file_count}/{downloader.files_count()} files, "
+              f"{depth} queued, {in_flight} in flight, {round(rate / 1024, 1)} KiB/s, {retries} retries",
+              flush=True)
@@ -1,8 +1,15 @@
 #!/usr/bin/env python3
 
 from wayback_machine_downloader import WaybackMachineDownloader
+from batch_downloader import BatchDownloader
+from download_shards import parse_shard
 import argparse
 import pprint
+import sys
+
+def shard(value):
+    parse_shard(value)
+    return value
 
 parser = argparse.ArgumentParser(description="Download an entire website from the Wayback Machine.",
                                  usage="wayback_machine_downloader http://example.com")
@@ -17,32 +24,100 @@ parser.add_argument("-t", "--to", dest="to_timestamp", type=int,
                     help="Only files on or before timestamp supplied (e.g., 20100916231334)")
 parser.add_argument("-e", "--exact-url", action="store_true",
                     help="Download only the url provided and not the full site")
-parser.add_argument("-o", "--only", dest="only_filter", type=str,
+parser.add_argument("-o", "--only", dest="only_filter", type=str, action="append",
                     help="Restrict downloading to urls that match this filter "
-                         "(use // notation for the filter to be treated as a regex)")
-parser.add_argument("-x", "--exclude", dest="exclude_filter", type=str,
+                         "(use // notation for the filter to be treated as a regex, repeat to allow several)")
+parser.add_argument("-x", "--exclude", dest="exclude_filter", type=str, action="append",
                     help="Skip downloading of urls that match this filter "
-                         "(use // notation for the filter to be treated as a regex)")
+                         "(use // notation for the filter to be treated as a regex, repeat to exclude several)")
 parser.add_argument("-a", "--all", dest="all", action="store_true",
                     help="Expand downloading to error files (40x and 50x) and redirections (30x)")
 parser.add_argument("-c", "--concurrency", dest="threads_count", type=int,
                     help="Number of multiple files to download at a time. "
                          "Default is one file at a time (e.g., 20)")
+parser.add_argument("--engine", dest="engine", choices=["threads", "asyncio"],
+                    help="Download engine to use. 'asyncio' keeps persistent connections to the archive "
+                         "and handles hundreds of concurrent downloads (Default is threads)")
+parser.add_argument("--rate-limit", dest="rate_limit", type=float,
+                    help="Maximum number of requests per second sent to the archive (Default is no limit)")
+parser.add_argument("--retries", dest="retries", type=int,
+                    help="Number of times a throttled or failed request is retried with backoff (Default is 5)")
 parser.add_argument("-p", "--maximum-snapshot", dest="maximum_pages", type=int,
                     help="Maximum snapshot pages to consider (Default is 100). "
                          "Count an average of 150,000 snapshots per page")
+parser.add_argument("--cdx-concurrency", dest="cdx_concurrency", type=int,
+                    help="Number of snapshot pages to fetch from the CDX API at a time (Default is 4)")
+parser.add_argument("--server-collapse", dest="server_collapse", action="store_true",
+                    help="Let the CDX API return a single row per url with the timestamp of its newest snapshot, "
+                         "so far fewer rows are transferred and curated (ignored with --all-timestamps)")
+parser.add_argument("--snapshot-index", dest="snapshot_index", action="store_true",
+                    help="Keep the snapshot list in a local index inside the backup directory "
+                         "and only ask the CDX API for snapshots newer than the last run")
+parser.add_argument("--journal", dest="journal", action="store_true",
+                    help="Record each file's download state in a journal inside the backup directory "
+                         "so an interrupted run resumes where it stopped")
+parser.add_argument("--dedupe", dest="deduplicate", action="store_true",
+                    help="Store each distinct snapshot body once and hard link identical snapshots to it "
+                         "(most useful with --all-timestamps)")
+parser.add_argument("--archive-url", dest="archive_url", metavar="URL",
+                    help="Base URL of the Wayback Machine to use (Default is https://web.archive.org), "
+                         "e.g. a local stand-in started by benchmark.py")
+parser.add_argument("--stats", dest="stats", metavar="PATH",
+                    help="Write a JSON performance report (phase timings, request latencies, retries, "
+                         "throughput, worker utilization) to PATH after downloading, or to stderr with -")
+parser.add_argument("--progress", dest="progress_interval", type=float, metavar="SECONDS",
+                    help="Print a progress line every SECONDS while downloading")
+parser.add_argument("--batch", dest="batch", metavar="FILE",
+                    help="Download every site listed in FILE (one URL per line, - for stdin) through one shared "
+                         "pool of --concurrency workers, each site in its own directory below --directory")
+parser.add_argument("--site-concurrency", dest="site_concurrency", type=int,
+                    help="Maximum files downloaded at a time from one site in --batch mode "
+                         "(Default is --concurrency)")
+parser.add_argument("--listing-concurrency", dest="listing_concurrency", type=int,
+                    help="Number of sites listed at a time in --batch mode (Default is 4)")
+parser.add_argument("--shard", dest="shard", type=shard, metavar="K/N",
+                    help="Download only shard K of N of the site (e.g., 2/8), split by file id, so several processes "
+                         "or machines can share one backup directory; each shard keeps its own journal")
+parser.add_argument("--verify-shards", dest="verify_shards", action="store_true",
+                    help="Check every planned file against the shard journals, report missing or incomplete files "
+                         "and merge the journals into one, won't download anything")
+parser.add_argument("--refresh", dest="refresh", action="store_true",
+                    help="Refresh an existing backup: record each file's snapshot timestamp and digest in a manifest "
+                         "and only download files whose newest snapshot changed since the last refresh")
+parser.add_argument("--stale", dest="stale", choices=["archive", "delete", "keep"], default="archive",
+                    help="With --refresh, what to do with files that are no longer listed: move them below "
+                         ".wayback/stale/, delete them or keep them. Old versions of changed files are moved below "
+                         ".wayback/stale/ with archive and overwritten otherwise (Default is archive)")
 parser.add_argument("-l", "--list", action="store_true",
                     help="Only list file urls in a JSON format with the archived timestamps, "
                          "won't download anything")
+parser.add_argument("--list-format", dest="list_format", choices=["json", "jsonl", "csv"], default="json",
+                    help="Output format of --list: a JSON array, JSON Lines or CSV (Default is json). Rows are "
+                         "written as they are curated; with --server-collapse (unless --snapshot-index) or --all-timestamps "
+                         "they start before the whole listing was read")
 parser.add_argument("-v", "--version", action="store_true", help="Display version")
 
 args = parser.parse_args()
 
-if args.base_url:
+if args.batch:
+    # Batch mode always downloads, with the asyncio engine and every file of each site
+    for option, given in (("--list", args.list), ("--verify-shards", args.verify_shards),
+                          ("--engine threads", args.engine == "threads"), ("--shard", args.shard),
+                          ("--progress", args.progress_interval), ("A base url", args.base_url)):
+        if given:
+            parser.error(f"{option} can't be combined with --batch")
+    options = vars(args)
+    BatchDownloader(BatchDownloader.read_sites(args.batch), options).run()
+elif args.base_url:
+    for option, given in (("--refresh", args.refresh), ("--snapshot-index", args.snapshot_index)):
+        if given and args.shard:
+            parser.error(f"{option} can't be combined with --shard")
     options = vars(args)
     wayback_machine_downloader = WaybackMachineDownloader(options)
     if args.list:
         wayback_machine_downloader.list_files()
+    elif args.verify_shards:
+        sys.exit(0 if wayback_machine_downloader.verify_shards() else 1)
     else:
         wayback_machine_downloader.download_files()
 elif args.version:
@@ -0,0 +1,188 @@
+import asyncio
+import email.utils
+import http.client
+import random
+import threading
+import time
+import urllib.error
+from contextlib import asynccontextmanager, contextmanager
+
+class RequestScheduler:
+
+    RETRY_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+    THROTTLE_STATUSES = {429, 503}
+    RETRY_EXCEPTIONS = (ConnectionError, TimeoutError, asyncio.TimeoutError, http.client.IncompleteRead,
+                        asyncio.IncompleteReadError)
+    BASE_DELAY = 1.0
+    MAXIMUM_DELAY = 120.0
+    DECREASE_INTERVAL = 5.0
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, maximum_concurrency, rate_limit=None, retries=5, timeout=60, stats=None):
+        self.maximum_concurrency = max(1, maximum_concurrency)
+        self.limit = float(self.maximum_concurrency)
+        self.rate_limit = rate_limit
+        self.retries = retries
+        self.timeout = timeout
+        self.stats = stats
+        self.tokens = float(self.burst)
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.last_decrease = 0.0
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+
+    @property
+    def burst(self):
+        return max(1, self.rate_limit or 1)
+
+    def call(self, function, description=None):
+        attempt = 0
+        while True:
+            with self.slot():
+                try:
+                    result = function()
+                except Exception as e:
+                    error = e
+                    delay = self.failure(error, attempt)
+                    if delay is None:
+                        raise
+                else:
+                    self.success()
+                    return result
+            self.report_retry(error, delay, description)
+            time.sleep(delay)
+            attempt += 1
+
+    async def call_async(self, coroutine_function, description=None):
+        attempt = 0
+        while True:
+            async with self.async_slot():
+                try:
+                    result = await coroutine_function()
+                except Exception as e:
+                    error = e
+                    delay = self.failure(error, attempt)
+                    if delay is None:
+                        raise
+                else:
+                    self.success()
+                    return result
+            self.report_retry(error, delay, description)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    @contextmanager
+    def slot(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+        try:
+            delay = self.reserve_token()
+            if delay > 0:
+                time.sleep(delay)
+            yield
+        finally:
+            self.release()
+
+    @asynccontextmanager
+    async def async_slot(self):
+        while not self.try_acquire():
+            await asyncio.sleep(self.POLL_INTERVAL)
+        try:
+            delay = self.reserve_token()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            yield
+        finally:
+            self.release()
+
+    def try_acquire(self):
+        with self.lock:
+            if self.in_flight >= int(self.limit):
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify()
+
+    def reserve_token(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = max(0.0, self.paused_until - now)
+            if self.rate_limit:
+                self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate_limit)
+                self.updated_at = now
+                self.tokens -= 1
+                if self.tokens < 0:
+                    delay = max(delay, -self.tokens / self.rate_limit)
+            return delay
+
+    def success(self):
+        # Additive increase: roughly one more concurrent request per window
+        # of successful ones.
+        with self.condition:
+            self.limit = min(self.maximum_concurrency, self.limit + 1 / self.limit)
+            self.condition.notify()
+
+    def throttled(self, retry_after=None):
+        # Multiplicative decrease, at most once per interval so a burst of
+        # failures from the same overload only halves the limit once.
+        with self.lock:
+            now = time.monotonic()
+            if now - self.last_decrease > self.DECREASE_INTERVAL:
+                self.limit = max(1.0, self.limit / 2)
+                self.last_decrease = now
+                if self.stats:
+                    self.stats.count('throttles')
+            if retry_after:
+                self.paused_until = max(self.paused_until, now + retry_after)
+
+    def failure(self, error, attempt):
+        status = getattr(error, 'code', None) or getattr(error, 'status', None)
+        if isinstance(status, int):
+            if status not in self.RETRY_STATUSES:
+                if self.stats:
+                    self.stats.failure(status, retrying=False)
+                return None
+        elif not isinstance(error, self.RETRY_EXCEPTIONS + (urllib.error.URLError,)):
+            return None
+
+        retry_after = self.retry_after(getattr(error, 'headers', None))
+        if status is None or status in self.THROTTLE_STATUSES:
+            self.throttled(retry_after)
+        if attempt >= self.retries:
+            if self.stats:
+                self.stats.failure(status, retrying=False)
+            return None
+        # Full jitter keeps workers that failed together from retrying together
+        delay = random.uniform(0, min(self.MAXIMUM_DELAY, self.BASE_DELAY * 2 ** attempt))
+        if self.stats:
+            self.stats.failure(status, retrying=True)
+        return max(delay, retry_after or 0)
+
+    @staticmethod
+    def retry_after(headers):
+        if not headers:
+            return None
+        value = headers.get('Retry-After') or headers.get('retry-after')
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def report_retry(error, delay, description):
+        print(f"{description} # {error}, retrying in {round(delay, 2)}s" if description else
+              f"{error}, retrying in {round(delay, 2)}s")
@@ -0,0 +1,80 @@
+import json
+import sqlite3
+from pathlib import Path
+
+class SnapshotIndex:
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS indexes (
+            id INTEGER PRIMARY KEY,
+            key TEXT UNIQUE NOT NULL,
+            last_timestamp TEXT
+        );
+        CREATE TABLE IF NOT EXISTS snapshots (
+            index_id INTEGER NOT NULL,
+            timestamp TEXT NOT NULL,
+            row TEXT NOT NULL,
+            PRIMARY KEY (index_id, row)
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path, key):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(str(path))
+        self.connection.executescript(self.SCHEMA)
+        self.connection.execute("INSERT OR IGNORE INTO indexes (key) VALUES (?)", (key,))
+        self.index_id, self.last_timestamp = self.connection.execute(
+            "SELECT id, last_timestamp FROM indexes WHERE key = ?", (key,)).fetchone()
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.connection.commit()
+        else:
+            self.connection.rollback()
+        self.connection.close()
+
+    def add(self, snapshots, batch_size=10000):
+        # New rows are handed back while they are inserted, so listing stays
+        # pipelined. They are only committed once the stream is exhausted: an
+        # interrupted refresh is rolled back and the next run asks again.
+        batch = []
+        for snapshot in snapshots:
+            row = json.dumps(snapshot)
+            if snapshot[0] == self.last_timestamp and self.contains(row):
+                # Asked again because 'from' is inclusive
+                continue
+            batch.append((self.index_id, snapshot[0], row))
+            if len(batch) >= batch_size:
+                self.insert(batch)
+                batch = []
+            yield snapshot
+        self.insert(batch)
+        self.connection.commit()
+
+    def advance(self):
+        # Only after a complete listing: CDX pages follow url order, not time,
+        # so rows skipped by a cut short listing may be older than the newest
+        # row it got, and asking 'from' that row would never fetch them.
+        last_timestamp, = self.connection.execute(
+            "SELECT max(timestamp) FROM snapshots WHERE index_id = ?", (self.index_id,)).fetchone()
+        self.connection.execute("UPDATE indexes SET last_timestamp = ? WHERE id = ?", (last_timestamp, self.index_id))
+        self.connection.commit()
+
+    def contains(self, row):
+        return self.connection.execute(
+            "SELECT 1 FROM snapshots WHERE index_id = ? AND row = ?", (self.index_id, row)).fetchone() is not None
+
+    def insert(self, batch):
+        self.connection.executemany("INSERT OR IGNORE INTO snapshots (index_id, timestamp, row) VALUES (?, ?, ?)", batch)
+
+    def count(self):
+        return self.connection.execute(
+            "SELECT count(*) FROM snapshots WHERE index_id = ?", (self.index_id,)).fetchone()[0]
+
+    def snapshots(self):
+        for row, in self.connection.execute("SELECT row FROM snapshots WHERE index_id = ?", (self.index_id,)):
+            yield json.loads(row)
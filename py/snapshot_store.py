@@ -0,0 +1,111 @@
+from array import array
+
+class FileRecord:
+
+    __slots__ = ('file_url', 'timestamp', 'file_id', 'digest', 'length')
+
+    def __init__(self, file_url, timestamp, file_id, digest=None, length=0):
+        self.file_url = file_url
+        self.timestamp = timestamp
+        self.file_id = file_id
+        self.digest = digest
+        self.length = length
+
+    def to_dict(self):
+        return {'file_url': self.file_url, 'timestamp': self.timestamp, 'file_id': self.file_id}
+
+
+class CuratedFileList:
+
+    # One slot per file: the dict only maps file ids to slot numbers, and the
+    # urls and integer timestamps live in flat columns instead of one dict per
+    # file.
+
+    __slots__ = ('slots', 'file_ids', 'file_urls', 'timestamps', 'digests', 'lengths')
+
+    def __init__(self):
+        self.slots = {}
+        self.file_ids = []
+        self.file_urls = []
+        self.timestamps = array('Q')
+        self.digests = []
+        self.lengths = array('Q')
+
+    def __len__(self):
+        return len(self.file_ids)
+
+    def __contains__(self, file_id):
+        return file_id in self.slots
+
+    def add(self, file_id, file_url, timestamp, digest=None, length=0):
+        self.slots[file_id] = len(self.file_ids)
+        self.file_ids.append(file_id)
+        self.file_urls.append(file_url)
+        self.timestamps.append(int(timestamp))
+        self.digests.append(digest)
+        self.lengths.append(length)
+
+    def add_newest(self, file_id, file_url, timestamp, digest=None, length=0):
+        timestamp = int(timestamp)
+        slot = self.slots.get(file_id)
+        if slot is None:
+            self.add(file_id, file_url, timestamp, digest, length)
+        elif not self.timestamps[slot] > timestamp:
+            self.file_urls[slot] = file_url
+            self.timestamps[slot] = timestamp
+            self.digests[slot] = digest
+            self.lengths[slot] = length
+
+    def by_timestamp(self, reverse=True):
+        return FileList(self, array('L', sorted(range(len(self)), key=self.timestamps.__getitem__, reverse=reverse)))
+
+    def in_order(self):
+        return FileList(self, array('L', range(len(self))))
+
+
+class FileList:
+
+    __slots__ = ('curated', 'order')
+
+    def __init__(self, curated, order):
+        self.curated = curated
+        self.order = order
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, index):
+        curated = self.curated
+        slot = self.order[index]
+        return FileRecord(curated.file_urls[slot], str(curated.timestamps[slot]), curated.file_ids[slot],
+                          curated.digests[slot], curated.lengths[slot])
+
+    def __iter__(self):
+        for index in range(len(self.order)):
+            yield self[index]
+
+
+def newest_per_file(file_snapshots):
+    # Single pass over (file_id, file_url, timestamp, digest, length) rows grouped by file id,
+    # holding only the best row of the current group. The timestamp emitted
+    # for each file id is remembered, so memory still grows with the number
+    # of files, if not with the number of rows. A file id showing up again
+    # later is emitted again only if it is newer, superseding the first row.
+    emitted = {}
+    current = None
+    for file_id, file_url, timestamp, digest, length in file_snapshots:
+        if current is not None and current.file_id == file_id:
+            if not int(current.timestamp) > int(timestamp):
+                current.file_url = file_url
+                current.timestamp = timestamp
+                current.digest = digest
+                current.length = length
+            continue
+        if current is not None:
+            emitted[current.file_id] = int(current.timestamp)
+            yield current
+        current = None
+        if not emitted.get(file_id, -1) > int(timestamp):
+            current = FileRecord(file_url, timestamp, file_id, digest, length)
+    if current is not None:
+        yield current
@@ -0,0 +1,42 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from request_scheduler import RequestScheduler
+from wayback_machine_downloader import WaybackMachineDownloader
+from wayback_stub import WaybackStub
+
+
+def site(files_count, timestamp=20100101000000, body=b'body %d ', host='example.com'):
+    # One snapshot per file with a distinct body
+    return [(timestamp, f"http://{host}/f{index}.html", (body % index) * 50) for index in range(files_count)]
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(RequestScheduler, 'BASE_DELAY', 0.01)
+
+
+@pytest.fixture
+def serve():
+    # Starts a WaybackStub over the given snapshots for the rest of the test
+    stubs = []
+
+    def start(snapshots, **options):
+        stubs.append(WaybackStub(snapshots, **options).start())
+        return stubs[-1]
+
+    yield start
+    for stub in stubs:
+        stub.stop()
+
+
+@pytest.fixture
+def downloader(tmp_path):
+    def make(stub, **params):
+        return WaybackMachineDownloader({'base_url': 'http://example.com', 'directory': str(tmp_path / 'backup'),
+                                         'archive_url': stub.url, **params})
+    return make
@@ -0,0 +1,27 @@
+import json
+
+from batch_downloader import BatchDownloader
+from conftest import site
+
+
+def test_batch_reports_each_site_and_the_whole_batch(serve, tmp_path):
+    snapshots = site(5, host='a.com') + site(3, host='b.com')
+    stub = serve(snapshots, error_rate=0.2, seed=3)
+    BatchDownloader(['http://a.com', 'http://b.com'],
+                    {'directory': str(tmp_path / 'backup'), 'archive_url': stub.url, 'threads_count': 4,
+                     'retries': 20, 'stats': str(tmp_path / 'stats.json')}).run()
+    report = json.loads((tmp_path / 'stats.json').read_text())
+
+    sites = {result['site']: result for result in report['sites']}
+    assert sites['http://a.com']['state'] == sites['http://b.com']['state'] == 'done'
+    assert (sites['http://a.com']['files_done'], sites['http://b.com']['files_done']) == (5, 3)
+    assert sites['http://b.com']['snapshot_bytes'] == sum(len(body) for _, _, body in site(3, host='b.com'))
+    assert (tmp_path / 'backup' / 'b.com' / 'f2.html').read_bytes() == site(3, host='b.com')[2][2]
+
+    counters = report['counters']
+    assert counters['files_done'] == 8
+    assert counters['snapshot_requests'] == 8
+    assert counters['snapshot_bytes'] == sum(len(body) for _, _, body in snapshots)
+    assert counters['cdx_requests'] == stub.request_counts['cdx']
+    assert counters['retries'] == stub.request_counts['errors']
+    assert report['latency']['snapshot']['count'] == 8
@@ -0,0 +1,34 @@
+import pytest
+
+ENGINES = ['threads', 'asyncio']
+
+
+def shared_body_site():
+    # Four snapshots over three files holding two distinct bodies
+    return [(20100101000000, 'http://example.com/a.html', b'shared body'),
+            (20120101000000, 'http://example.com/a.html', b'shared body'),
+            (20100101000000, 'http://example.com/b.html', b'shared body'),
+            (20100101000000, 'http://example.com/c.html', b'other body')]
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_identical_snapshots_are_fetched_once_and_linked(serve, downloader, tmp_path, engine):
+    stub = serve(shared_body_site())
+    current = downloader(stub, engine=engine, all_timestamps=True, deduplicate=True)
+    current.download_files()
+
+    assert stub.request_counts['web'] == 2
+    assert current.stats.counters['files_linked'] == 2
+    backup_path = tmp_path / 'backup'
+    shared = [backup_path / '20100101000000' / 'a.html', backup_path / '20120101000000' / 'a.html',
+              backup_path / '20100101000000' / 'b.html']
+    assert {path.read_bytes() for path in shared} == {b'shared body'}
+    assert len({path.stat().st_ino for path in shared}) == 1
+    assert (backup_path / '20100101000000' / 'c.html').read_bytes() == b'other body'
+
+
+def test_stored_bodies_are_reused_by_later_runs(serve, downloader, tmp_path):
+    downloader(serve(shared_body_site()[:1]), deduplicate=True).download_files()
+    stub = serve(shared_body_site())
+    downloader(stub, all_timestamps=True, deduplicate=True).download_files()
+    assert stub.request_counts['web'] == 1
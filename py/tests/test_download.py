@@ -0,0 +1,148 @@
+import asyncio
+import json
+import socket
+import threading
+import time
+
+import pytest
+
+from async_downloader import AsyncDownloadEngine, HTTPConnectionPool
+from conftest import site
+from wayback_stub import WaybackStubHandler
+
+ENGINES = ['threads', 'asyncio']
+
+
+def journal_entry(file_id, timestamp, state='in-progress'):
+    return json.dumps({'file_id': file_id, 'file_url': f"http://example.com/{file_id}", 'timestamp': timestamp,
+                       'state': state}) + '\n'
+
+
+def interrupted(backup_path, file_id, timestamp, part_body):
+    # What a run killed while fetching file_id leaves behind
+    (backup_path / '.wayback').mkdir(parents=True)
+    (backup_path / f"{file_id}.part").write_bytes(part_body)
+    (backup_path / '.wayback' / 'journal.jsonl').write_text(journal_entry(file_id, timestamp))
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_engines_download_every_file(serve, downloader, tmp_path, engine):
+    snapshots = site(50)
+    stub = serve(snapshots)
+    current = downloader(stub, engine=engine, threads_count=8)
+    current.download_files()
+    assert stub.request_counts['web'] == 50
+    assert current.stats.counters['files_done'] == 50
+    for _, file_url, body in snapshots:
+        assert (tmp_path / 'backup' / file_url.rsplit('/', 1)[1]).read_bytes() == body
+
+
+async def download_async(downloader, planned_file):
+    engine = AsyncDownloadEngine(downloader, 1, HTTPConnectionPool(downloader.archive_url, 1, 5))
+    try:
+        await engine.download_file(planned_file)
+    finally:
+        await engine.pool.close()
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_engines_follow_redirects_to_the_nearest_snapshot(serve, downloader, tmp_path, engine):
+    stub = serve([(20100101000000, 'http://example.com/a.html', b'a')])
+    current = downloader(stub, engine=engine)
+    # Asked for a later timestamp, the archive redirects to the capture it has
+    planned_file = current.download_plan[0]._replace(timestamp='20120101000000')
+    current.start_download()
+    try:
+        if engine == 'asyncio':
+            asyncio.run(download_async(current, planned_file))
+        else:
+            current.download_file(planned_file)
+    finally:
+        current.finish_download()
+    assert (tmp_path / 'backup' / 'a.html').read_bytes() == b'a'
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_part_file_of_another_snapshot_is_not_resumed(serve, downloader, tmp_path, engine):
+    body = b'new snapshot ' * 20
+    interrupted(tmp_path / 'backup', 'a.html', '20100101000000', b'old snapshot ' * 10)
+    stub = serve([(20150101000000, 'http://example.com/a.html', body)])
+    downloader(stub, engine=engine, journal=True).download_files()
+    assert (tmp_path / 'backup' / 'a.html').read_bytes() == body
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_part_file_of_the_same_snapshot_is_resumed(serve, downloader, tmp_path, engine):
+    body = b'same snapshot ' * 20
+    interrupted(tmp_path / 'backup', 'a.html', '20150101000000', body[:100])
+    stub = serve([(20150101000000, 'http://example.com/a.html', body)])
+    current = downloader(stub, engine=engine, journal=True)
+    current.download_files()
+    assert (tmp_path / 'backup' / 'a.html').read_bytes() == body
+    assert current.stats.statuses['206'] == 1
+    assert current.stats.counters['snapshot_bytes'] == len(body) - 100
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_partial_content_from_the_wrong_offset_restarts(serve, downloader, tmp_path, engine, monkeypatch):
+    def send_snapshot(handler, timestamp, file_url):
+        # Answers a Range request with the whole body, labelled as partial
+        snapshot = handler.server.stub.snapshot(timestamp, file_url)
+        content_range = f"bytes 0-{len(snapshot.body) - 1}/{len(snapshot.body)}"
+        handler.send_body(206, snapshot.body, [("Content-Range", content_range)])
+    monkeypatch.setattr(WaybackStubHandler, 'send_snapshot', send_snapshot)
+
+    body = b'whole body ' * 20
+    interrupted(tmp_path / 'backup', 'a.html', '20150101000000', body[:100])
+    stub = serve([(20150101000000, 'http://example.com/a.html', body)])
+    downloader(stub, engine=engine, journal=True).download_files()
+    assert (tmp_path / 'backup' / 'a.html').read_bytes() == body
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_all_with_injected_errors_keeps_bodies_intact(serve, downloader, tmp_path, engine):
+    snapshots = site(40)
+    stub = serve(snapshots, error_rate=0.3, seed=1)
+    downloader(stub, engine=engine, threads_count=8, retries=20, all=True).download_files()
+    assert stub.request_counts['errors']
+    for _, file_url, body in snapshots:
+        assert (tmp_path / 'backup' / file_url.rsplit('/', 1)[1]).read_bytes() == body
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_all_saves_the_last_error_body(serve, downloader, tmp_path, engine):
+    stub = serve([(20100101000000, 'http://example.com/a.html', b'gone', 404)])
+    downloader(stub, engine=engine, all=True).download_files()
+    assert (tmp_path / 'backup' / 'a.html').read_bytes() == b'gone'
+
+
+def test_stalled_body_times_out():
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen()
+
+    def stall():
+        connection, _ = listener.accept()
+        connection.recv(4096)
+        connection.sendall(b'HTTP/1.1 200 OK\r\nContent-Length: 100\r\n\r\nabc')
+        stopped.wait()
+        connection.close()
+
+    stopped = threading.Event()
+    threading.Thread(target=stall, daemon=True).start()
+
+    async def fetch():
+        pool = HTTPConnectionPool(f"http://127.0.0.1:{listener.getsockname()[1]}", 1, timeout=0.2)
+        try:
+            await asyncio.wait_for(pool.get('/', lambda status, headers: lambda chunk: None), 5)
+        finally:
+            await pool.close()
+
+    start = time.perf_counter()
+    try:
+        with pytest.raises(TimeoutError):
+            asyncio.run(fetch())
+        assert time.perf_counter() - start < 2
+    finally:
+        stopped.set()
+        listener.close()
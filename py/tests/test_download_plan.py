@@ -0,0 +1,36 @@
+from download_plan import DownloadPlan
+from snapshot_store import FileRecord
+
+
+def plan(tmp_path, *file_urls):
+    return DownloadPlan(tmp_path, [FileRecord(file_url, '20100101000000', file_url.split('/', 3)[3])
+                                   for file_url in file_urls])
+
+
+def test_file_with_files_below_it_becomes_the_directory_index(tmp_path):
+    download_plan = plan(tmp_path, 'http://example.com/docs', 'http://example.com/docs/a.html')
+    assert download_plan[0].file_path == tmp_path / 'docs' / 'index.html'
+    assert download_plan[1].file_path == tmp_path / 'docs' / 'a.html'
+    assert download_plan.directories == {'docs'}
+
+
+def test_file_with_an_extension_and_files_below_it(tmp_path):
+    download_plan = plan(tmp_path, 'http://example.com/a/b.php/c.html', 'http://example.com/a/b.php')
+    assert download_plan[1].file_path == tmp_path / 'a' / 'b.php' / 'index.html'
+    assert download_plan.directories == {'a', 'a/b.php'}
+
+
+def test_urls_without_extension_or_with_a_slash_are_directory_indexes(tmp_path):
+    download_plan = plan(tmp_path, 'http://example.com/', 'http://example.com/about/', 'http://example.com/team')
+    assert [planned_file.file_path for planned_file in download_plan] == [
+        tmp_path / 'index.html', tmp_path / 'about' / 'index.html', tmp_path / 'team' / 'index.html']
+
+
+def test_conflicting_tree_left_by_an_earlier_run_is_fixed(serve, downloader, tmp_path):
+    # An earlier run saved "docs" as a file before files below it appeared
+    (tmp_path / 'backup').mkdir()
+    (tmp_path / 'backup' / 'docs').write_bytes(b'old docs')
+    stub = serve([(20100101000000, 'http://example.com/docs/a.html', b'a')])
+    downloader(stub).download_files()
+    assert (tmp_path / 'backup' / 'docs' / 'index.html').read_bytes() == b'old docs'
+    assert (tmp_path / 'backup' / 'docs' / 'a.html').read_bytes() == b'a'
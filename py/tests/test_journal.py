@@ -0,0 +1,30 @@
+import json
+from collections import namedtuple
+
+from download_journal import DownloadJournal
+
+Planned = namedtuple('Planned', ['file_id', 'file_url', 'timestamp'])
+
+
+def test_torn_last_line_is_skipped_and_appends_start_on_a_new_line(tmp_path):
+    path = tmp_path / 'journal.jsonl'
+    done = {'file_id': 'a.html', 'file_url': 'http://example.com/a.html', 'timestamp': '20100101000000',
+            'state': DownloadJournal.DONE}
+    path.write_text(json.dumps(done) + '\n' + '{"file_id": "b.html", "sta')
+
+    with DownloadJournal(path) as journal:
+        assert journal.is_done('a.html')
+        assert journal.state('b.html') == DownloadJournal.PENDING
+        journal.record(Planned('b.html', 'http://example.com/b.html', '20100101000000'), DownloadJournal.DONE)
+
+    with DownloadJournal(path) as journal:
+        assert journal.is_done('a.html') and journal.is_done('b.html')
+
+
+def test_resumable_only_for_the_same_snapshot(tmp_path):
+    with DownloadJournal(tmp_path / 'journal.jsonl') as journal:
+        planned = Planned('a.html', 'http://example.com/a.html', '20100101000000')
+        assert not journal.resumable(planned)
+        journal.record(planned, DownloadJournal.IN_PROGRESS)
+        assert journal.resumable(planned)
+        assert not journal.resumable(planned._replace(timestamp='20150101000000'))
@@ -0,0 +1,89 @@
+import io
+import sqlite3
+
+from conftest import site
+from snapshot_store import newest_per_file
+from wayback_machine_downloader import WaybackMachineDownloader
+
+
+def listing_requests(pages_count):
+    # The exact url, the page count and every page
+    return 2 + pages_count
+
+
+def test_resumed_run_lists_once(serve, downloader, monkeypatch):
+    stub = serve(site(30), page_size=10)
+    listings = []
+    get_snapshots_from_api = WaybackMachineDownloader.get_snapshots_from_api
+    monkeypatch.setattr(WaybackMachineDownloader, 'get_snapshots_from_api',
+                        lambda self: listings.append(self) or get_snapshots_from_api(self))
+
+    downloader(stub, threads_count=4).download_files()
+    assert len(listings) == 1
+    assert stub.request_counts['cdx'] == listing_requests(3)
+    assert stub.request_counts['web'] == 30
+
+    stub.request_counts.clear()
+    downloader(stub, threads_count=4, journal=True).download_files()
+    assert len(listings) == 2
+    assert stub.request_counts['cdx'] == listing_requests(3)
+    assert stub.request_counts['web'] == 0
+
+
+def listed(downloader):
+    output = io.StringIO()
+    downloader.list_files(output)
+    return sorted(tuple(line.split(',')) for line in output.getvalue().splitlines()[1:])
+
+
+def test_snapshot_index_stores_each_row_once(serve, downloader):
+    snapshots = [(20100101000000, 'http://example.com/a.html', b'a1'),
+                 (20150101000000, 'http://example.com/a.html', b'a2')]
+    stub = serve(snapshots)
+    for _ in range(3):
+        # Later runs ask again from the last indexed timestamp on, inclusive
+        current = downloader(stub, snapshot_index=True, list_format='csv')
+        assert listed(current) == [('http://example.com/a.html', '20150101000000', 'a.html')]
+    connection = sqlite3.connect(str(current.state_path() / 'snapshots.sqlite'))
+    assert connection.execute("SELECT count(*) FROM snapshots").fetchone() == (2,)
+    connection.close()
+
+
+def test_snapshot_index_lists_everything_after_a_cut_short_listing(serve, downloader):
+    # Pages follow url order, so the pages left out hold older snapshots
+    stub = serve([(20100101000010 - index, f"http://example.com/f{index}.html", b'body') for index in range(6)],
+                 page_size=2)
+    current = downloader(stub, snapshot_index=True, list_format='csv', maximum_pages=1)
+    assert len(listed(current)) == 2
+    assert not current.listing_complete
+
+    current = downloader(stub, snapshot_index=True, list_format='csv', maximum_pages=10)
+    assert len(listed(current)) == 6
+    assert current.listing_complete
+
+
+def test_newest_per_file_keeps_the_newest_row_of_each_group():
+    rows = [('a', 'u', '2010', None, 0), ('a', 'u', '2012', None, 0), ('a', 'u', '2011', None, 0),
+            ('b', 'u', '2011', None, 0)]
+    assert [(record.file_id, record.timestamp) for record in newest_per_file(rows)] == [('a', '2012'), ('b', '2011')]
+
+
+def test_newest_per_file_supersedes_an_emitted_file_only_with_a_newer_row():
+    rows = [('a', 'u', '2012', None, 0), ('b', 'u', '2011', None, 0), ('a', 'u', '2010', None, 0),
+            ('c', 'u', '2011', None, 0), ('a', 'u', '2015', None, 0)]
+    assert [(record.file_id, record.timestamp) for record in newest_per_file(rows)] == \
+        [('a', '2012'), ('b', '2011'), ('c', '2011'), ('a', '2015')]
+
+
+def test_snapshot_index_lists_the_newest_snapshot(serve, downloader):
+    first = [(20100101000000, 'http://example.com/a.html', b'a1'), (20100101000000, 'http://example.com/b.html', b'b1')]
+    later = [(20150101000000, 'http://example.com/a.html', b'a2')]
+    params = {'snapshot_index': True, 'server_collapse': True, 'list_format': 'csv'}
+    assert listed(downloader(serve(first), **params)) == [
+        ('http://example.com/a.html', '20100101000000', 'a.html'),
+        ('http://example.com/b.html', '20100101000000', 'b.html')]
+
+    stub = serve(first + later)
+    assert listed(downloader(stub, **params)) == [
+        ('http://example.com/a.html', '20150101000000', 'a.html'),
+        ('http://example.com/b.html', '20100101000000', 'b.html')]
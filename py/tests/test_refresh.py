@@ -0,0 +1,99 @@
+import pytest
+
+from conftest import site
+
+ENGINES = ['threads', 'asyncio']
+
+
+def backup_files(backup_path):
+    return {path.relative_to(backup_path).as_posix(): path.read_bytes()
+            for path in backup_path.rglob('*') if path.is_file() and path.parent.name != '.wayback'}
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_refresh_fetches_only_changed_files_and_archives_the_rest(serve, downloader, tmp_path, engine):
+    first = site(5)
+    downloader(serve(first), refresh=True, engine=engine).download_files()
+
+    stub = serve(first)
+    downloader(stub, refresh=True, engine=engine).download_files()
+    assert stub.request_counts['web'] == 0
+
+    # f1 changed, f4 is gone and f5 is new
+    later = first[:4] + [(20150101000000, 'http://example.com/f1.html', b'changed'),
+                         (20150101000000, 'http://example.com/f5.html', b'new')]
+    stub = serve([snapshot for snapshot in later if not snapshot[1].endswith('f4.html')])
+    current = downloader(stub, refresh=True, engine=engine)
+    current.download_files()
+    assert stub.request_counts['web'] == 2
+
+    files = backup_files(tmp_path / 'backup')
+    stale_name = current.stale_path().relative_to(tmp_path / 'backup').as_posix()
+    assert files == {'f0.html': first[0][2], 'f1.html': b'changed', 'f2.html': first[2][2], 'f3.html': first[3][2],
+                     'f5.html': b'new', f"{stale_name}/f1.html": first[1][2], f"{stale_name}/f4.html": first[4][2]}
+
+
+def test_refresh_leaves_files_outside_the_filters(serve, downloader, tmp_path):
+    snapshots = site(2) + site(1, timestamp=20150101000000, body=b'f2 %d')
+    snapshots[2] = (snapshots[2][0], 'http://example.com/f2.html', snapshots[2][2])
+    downloader(serve(snapshots), refresh=True).download_files()
+    downloader(serve(snapshots), refresh=True, only_filter=['f0.html'], exclude_filter=['f2']).download_files()
+    downloader(serve(snapshots), refresh=True, to_timestamp=2011, exclude_filter=['f1']).download_files()
+    assert sorted(backup_files(tmp_path / 'backup')) == ['f0.html', 'f1.html', 'f2.html']
+
+
+def test_refresh_keeps_files_when_the_listing_is_incomplete(serve, downloader, tmp_path):
+    snapshots = site(6)
+    downloader(serve(snapshots), refresh=True).download_files()
+    downloader(serve(snapshots, page_size=2), refresh=True, maximum_pages=1).download_files()
+    assert len(backup_files(tmp_path / 'backup')) == 6
+
+
+@pytest.mark.parametrize('stale', ['delete', 'keep'])
+def test_stale_action(serve, downloader, tmp_path, stale):
+    snapshots = site(2)
+    downloader(serve(snapshots), refresh=True).download_files()
+    downloader(serve(snapshots[:1]), refresh=True, stale=stale).download_files()
+    assert sorted(backup_files(tmp_path / 'backup')) == (['f0.html'] if stale == 'delete' else ['f0.html', 'f1.html'])
+
+
+def test_refreshes_in_the_same_second_archive_apart(serve, downloader):
+    stub = serve(site(1))
+    stale_paths = [downloader(stub, refresh=True).stale_path() for _ in range(3)]
+    assert len(set(stale_paths)) == 3
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_refresh_links_a_changed_file_over_its_old_version(serve, downloader, tmp_path, engine):
+    first = site(2)
+    downloader(serve(first), refresh=True, deduplicate=True, engine=engine).download_files()
+
+    # f1 now holds the bytes f0 already has in the store
+    stub = serve([first[0], (20150101000000, 'http://example.com/f1.html', first[0][2])])
+    current = downloader(stub, refresh=True, deduplicate=True, engine=engine)
+    current.download_files()
+    assert stub.request_counts['web'] == 0
+
+    files = backup_files(tmp_path / 'backup')
+    stale_name = current.stale_path().relative_to(tmp_path / 'backup').as_posix()
+    assert files['f1.html'] == first[0][2]
+    assert files[f"{stale_name}/f1.html"] == first[1][2]
+    assert not (tmp_path / 'backup' / 'f1.html.link').exists()
+
+
+def test_failed_refresh_keeps_the_old_version_tracked(serve, downloader, tmp_path):
+    first = site(2)
+    downloader(serve(first), refresh=True).download_files()
+
+    stub = serve(first[:1] + [(20150101000000, 'http://example.com/f1.html', b'changed')])
+    failing = downloader(stub, refresh=True, retries=0)
+    failing.download_plan
+    stub.error_rate = 1.0
+    failing.download_files()
+    assert backup_files(tmp_path / 'backup')['f1.html'] == first[1][2]
+
+    # Once f1 is no longer listed its old version is still found and archived
+    current = downloader(serve(first[:1]), refresh=True)
+    current.download_files()
+    stale_name = current.stale_path().relative_to(tmp_path / 'backup').as_posix()
+    assert set(backup_files(tmp_path / 'backup')) == {'f0.html', f"{stale_name}/f1.html"}
@@ -0,0 +1,52 @@
+import pytest
+
+from conftest import site
+from download_journal import DownloadJournal
+from download_shards import parse_shard
+
+
+def test_parse_shard():
+    assert parse_shard('2/8') == (1, 8)
+    for value in ('0/4', '5/4', '1', 'a/b'):
+        with pytest.raises(ValueError):
+            parse_shard(value)
+
+
+def test_shards_split_the_plan(serve, downloader, tmp_path):
+    stub = serve(site(30))
+    shards = [downloader(stub, shard=f"{number}/3") for number in (1, 2, 3)]
+    for shard in shards:
+        shard.download_files()
+
+    file_indexes = [set(shard.shard_indexes) for shard in shards]
+    assert all(file_indexes)
+    assert sum(len(indexes) for indexes in file_indexes) == 30
+    assert set().union(*file_indexes) == set(range(30))
+    assert len(list((tmp_path / 'backup').glob('*.html'))) == 30
+    assert downloader(stub).verify_shards()
+
+
+def test_verify_shards_finds_lost_and_resized_files(serve, downloader, tmp_path, capsys):
+    stub = serve(site(6))
+    for number in (1, 2):
+        downloader(stub, shard=f"{number}/2").download_files()
+    (tmp_path / 'backup' / 'f1.html').unlink()
+    with open(tmp_path / 'backup' / 'f2.html', 'ab') as file:
+        file.write(b'torn')
+
+    assert not downloader(stub).verify_shards()
+    output = capsys.readouterr().out
+    assert 'f1.html # lost' in output
+    assert 'f2.html # size mismatch' in output
+    assert '1 lost, 4 ok, 1 size mismatch' in output
+
+    # The merged journal sends both back to the next --journal run
+    journal = DownloadJournal(tmp_path / 'backup' / '.wayback' / 'journal.jsonl')
+    journal.close()
+    states = {entry['problem']: entry['state'] for entry in journal.entries.values() if 'problem' in entry}
+    assert states == {'lost': DownloadJournal.FAILED, 'size mismatch': DownloadJournal.FAILED}
+
+
+def test_shards_refuse_a_shared_snapshot_index(serve, downloader):
+    with pytest.raises(ValueError):
+        downloader(serve(site(1)), shard='1/2', snapshot_index=True)
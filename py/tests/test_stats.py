@@ -0,0 +1,30 @@
+import json
+
+from conftest import site
+
+
+def test_stats_report(serve, downloader, tmp_path):
+    stub = serve(site(20), error_rate=0.2, seed=3)
+    downloader(stub, threads_count=4, retries=20, stats=str(tmp_path / 'stats.json')).download_files()
+    report = json.loads((tmp_path / 'stats.json').read_text())
+
+    assert {'planning', 'directories', 'download'} <= set(report['phases_s'])
+    counters = report['counters']
+    assert counters['files_done'] == 20
+    assert counters['snapshot_requests'] == 20
+    assert counters['snapshot_bytes'] == sum(len(body) for _, _, body in site(20))
+    assert counters['cdx_requests'] == stub.request_counts['cdx']
+    assert counters['retries'] == stub.request_counts['errors']
+    assert report['statuses']['200'] == 20 + stub.request_counts['cdx']
+    assert report['statuses']['503'] == stub.request_counts['errors']
+    assert report['latency']['snapshot']['count'] == 20
+    assert report['workers'] == 4
+    assert 0 < report['worker_utilization'] <= 1
+    assert report['bytes_per_second'] > 0
+
+
+def test_stats_to_stderr_keeps_stdout_for_file_lines(serve, downloader, capsys):
+    downloader(serve(site(2)), stats='-').download_files()
+    captured = capsys.readouterr()
+    assert json.loads(captured.err)['counters']['files_done'] == 2
+    assert '"counters"' not in captured.out
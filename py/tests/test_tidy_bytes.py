@@ -0,0 +1,26 @@
+from tidy_bytes import tidy_bytes
+
+
+def test_valid_utf8_is_decoded():
+    assert tidy_bytes('café “quoted”'.encode('utf-8')) == 'café “quoted”'
+
+
+def test_invalid_bytes_are_read_as_cp1252():
+    assert tidy_bytes(b'caf\xe9 \x93quoted\x94 \xe2\x82\xac') == 'café “quoted” €'
+
+
+def test_undefined_cp1252_bytes_are_dropped():
+    assert tidy_bytes(b'a\x81b\x9dc') == 'abc'
+
+
+def test_truncated_and_surrogate_sequences_are_tidied_byte_by_byte():
+    assert tidy_bytes(b'\xe2\x82a\xed\xa0\x80') == 'â‚aí\xa0€'
+
+
+def test_latin1_strings_and_decoded_strings():
+    assert tidy_bytes('caf\xc3\xa9') == 'café'
+    assert tidy_bytes('€ already decoded') == '€ already decoded'
+
+
+def test_force_reads_everything_as_cp1252():
+    assert tidy_bytes('é'.encode('utf-8'), force=True) == 'Ã©'
@@ -0,0 +1,22 @@
+from url_filter import UrlFilter
+
+URLS = ['http://example.com/Images/Logo.PNG', 'http://example.com/blog/post.html', 'http://example.com/style.css']
+
+
+def test_substrings_match_case_insensitively():
+    assert UrlFilter(['IMAGES']).match_batch(URLS) == [True, False, False]
+
+
+def test_regexes_are_case_sensitive_unless_flagged():
+    assert UrlFilter(['/\\.png$/']).match_batch(URLS) == [False, False, False]
+    assert UrlFilter(['/\\.png$/i']).match_batch(URLS) == [True, False, False]
+
+
+def test_any_pattern_matches():
+    assert UrlFilter(['/\\.css$/', 'blog']).match_batch(URLS) == [False, True, True]
+    assert [UrlFilter(['/\\.css$/', 'blog']).match(url) for url in URLS] == [False, True, True]
+
+
+def test_no_patterns():
+    assert not UrlFilter(None)
+    assert UrlFilter([]).match_batch(URLS) == [False, False, False]
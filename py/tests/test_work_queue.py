@@ -0,0 +1,66 @@
+from snapshot_store import FileRecord
+from wayback_machine_downloader import WaybackMachineDownloader
+from work_queue import WorkQueue
+
+
+def record(file_id, length=0, host='example.com'):
+    return FileRecord(f"http://{host}/{file_id}", '20100101000000', file_id, length=length)
+
+
+def drain(queue, worker=0):
+    items = []
+    while (item := queue.get(worker)) is not None:
+        items.append(item)
+    return items
+
+
+def test_priority_classes():
+    assert WorkQueue.priority(record('index.html')) == WorkQueue.PAGES
+    assert WorkQueue.priority(record('about/')) == WorkQueue.PAGES
+    assert WorkQueue.priority(record('logo.png')) == WorkQueue.ASSETS
+    assert WorkQueue.priority(record('video.MP4')) == WorkQueue.LARGE
+    assert WorkQueue.priority(record('logo.png', length=2 ** 21)) == WorkQueue.LARGE
+
+
+def test_pages_come_before_assets_and_large_files():
+    file_list = [record('a.pdf'), record('b.png'), record('c.html'), record('d.css')]
+    assert drain(WorkQueue(1).fill(file_list)) == [2, 3, 1, 0]
+
+
+def test_hosts_take_turns_within_a_class():
+    queue = WorkQueue(1)
+    for item, host in enumerate(['a.com', 'a.com', 'a.com', 'b.com', 'b.com']):
+        queue.put(item, host)
+    assert drain(queue) == [0, 3, 1, 4, 2]
+
+
+def test_idle_workers_steal_from_the_back_of_other_shards():
+    queue = WorkQueue(2)
+    for item in range(6):
+        queue.put(item)
+    # Items are dealt round robin: shard 0 holds 0, 2, 4 and shard 1 holds 1, 3, 5
+    assert [queue.get(0), queue.get(0), queue.get(0)] == [0, 2, 4]
+    assert queue.get(0) == 5
+    assert drain(queue, 1) == [1, 3]
+    assert len(queue) == 0
+
+
+def test_shards_steal_a_higher_priority_before_their_own_lower_one():
+    queue = WorkQueue(2)
+    queue.put('page', priority=WorkQueue.PAGES)
+    queue.put('large', priority=WorkQueue.LARGE)
+    assert queue.get(1) == 'page'
+
+
+def test_download_order_follows_priority(serve, downloader, monkeypatch):
+    stub = serve([(20100101000000, f"http://example.com/{name}", b'body')
+                  for name in ('a.pdf', 'b.png', 'c.html', 'd.zip', 'e.css')])
+    downloaded = []
+    download_file = WaybackMachineDownloader.download_file
+    monkeypatch.setattr(WaybackMachineDownloader, 'download_file',
+                        lambda self, planned_file: downloaded.append(planned_file.file_id) or
+                        download_file(self, planned_file))
+    downloader(stub).download_files()
+    assert set(downloaded[:2]) == {'c.html', 'e.css'}
+    assert downloaded[2] == 'b.png'
+    assert stub.request_counts['web'] == 5
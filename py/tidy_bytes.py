@@ -1,3 +1,6 @@
+import codecs
+import re
+
 CP1252 = {
     128: [226, 130, 172],
     129: None,
@@ -41,41 +44,40 @@ def tidy_byte(byte):
     else:
         return [195, byte - 64]
 
-def tidy_bytes(string, force=False):
-    bytes_list = list(string.encode('latin-1'))
-
-    if force:
-        return bytearray([b for tidy_byte_list in (tidy_byte(b) for b in bytes_list) if tidy_byte_list for b in tidy_byte_list]).decode('utf-8', 'replace')
+# Each byte outside valid UTF-8 decoded on its own as tidy_byte does it:
+# CP1252 for 128-159, with the five undefined ones dropped, and Latin-1
+# above. U+FFFE marks a byte the charmap codec leaves undefined.
+TIDY_TABLE = ''.join(chr(byte) if byte < 128 else bytes(tidy_byte(byte)).decode('utf-8') if tidy_byte(byte) else '\ufffe'
+                     for byte in range(256))
 
-    conts_expected = 0
-    last_lead = 0
+VALID_UTF8 = re.compile(rb'((?:[\x00-\x7f]|[\xc2-\xdf][\x80-\xbf]|\xe0[\xa0-\xbf][\x80-\xbf]'
+                        rb'|[\xe1-\xec\xee\xef][\x80-\xbf]{2}|\xed[\x80-\x9f][\x80-\xbf]'
+                        rb'|\xf0[\x90-\xbf][\x80-\xbf]{2}|[\xf1-\xf3][\x80-\xbf]{3}|\xf4[\x80-\x8f][\x80-\xbf]{2})+)')
 
-    for i, byte in enumerate(bytes_list):
-        is_ascii = byte < 128
-        is_cont = 127 < byte < 192
-        is_lead = 191 < byte < 245
-        is_unused = byte > 240
-        is_restricted = byte > 244
+def tidy_invalid_runs(data):
+    # Splitting on valid runs leaves the invalid ones at even indexes. None
+    # of them holds a NUL byte, so they are all decoded through the table in
+    # one call and split apart again, with no Python code per run.
+    pieces = VALID_UTF8.split(data)
+    tidied = codecs.charmap_decode(b'\x00'.join(pieces[0::2]), 'ignore', TIDY_TABLE)[0]
+    pieces[0::2] = tidied.encode('utf-8').split(b'\x00')
+    return b''.join(pieces).decode('utf-8')
 
-        if is_unused or is_restricted:
-            bytes_list[i] = tidy_byte(byte)
-        elif is_cont:
-            if conts_expected == 0:
-                bytes_list[i] = tidy_byte(byte)
-            else:
-                conts_expected -= 1
-        else:
-            if conts_expected > 0:
-                for j in range(1, i - last_lead + 1):
-                    bytes_list[i - j] = tidy_byte(bytes_list[i - j])
-                conts_expected = 0
+def tidy_bytes(string, force=False):
+    if isinstance(string, str):
+        try:
+            data = string.encode('latin-1')
+        except UnicodeEncodeError:
+            # Characters above U+00FF mean the string was already decoded
+            return string
+    else:
+        data = bytes(string)
 
-            if is_lead:
-                if i == len(bytes_list) - 1:
-                    bytes_list[i] = tidy_byte(bytes_list[-1])
-                else:
-                    conts_expected = 1 if byte < 224 else 2 if byte < 240 else 3
-                    last_lead = i
+    if force:
+        return codecs.charmap_decode(data, 'ignore', TIDY_TABLE)[0]
 
-    tidy_byte_lists = [tidy_byte_list for tidy_byte_list in (tidy_byte(b) for b in bytes_list) if tidy_byte_list]
-    return bytearray([b for tidy_byte_list in tidy_byte_lists for b in tidy_byte_list]).decode('utf-8', 'replace')
+    # Valid UTF-8 is decoded at C speed in one go
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        return tidy_invalid_runs(data)
@@ -13,7 +13,8 @@ class ToRegexMixin:
 
     def to_regex(self, string, **options):
         if args := self.as_regexp(string, **options):
-            return re.compile(*args)
+            # Python has no per-pattern encoding option, so the Ruby language flag is dropped
+            return re.compile(*args[:2])
         return None
 
     def as_regexp(self, string, literal=None, detect=None, ignore_case=None, multiline=None, extended=None, lang=None):
@@ -0,0 +1,37 @@
+from to_regex import ToRegexMixin
+
+class UrlFilter(ToRegexMixin):
+
+    def __init__(self, patterns):
+        if isinstance(patterns, str):
+            patterns = [patterns]
+        self.patterns = [pattern for pattern in patterns or [] if pattern]
+        self.regexes = []
+        self.literals = []
+        for pattern in self.patterns:
+            regex = self.to_regex(pattern)
+            if regex:
+                self.regexes.append(regex)
+            else:
+                self.literals.append(pattern.lower())
+        self.literals = list(dict.fromkeys(self.literals))
+
+    def __bool__(self):
+        return bool(self.patterns)
+
+    def match(self, file_url):
+        return self.match_batch([file_url])[0]
+
+    def match_batch(self, file_urls):
+        # Patterns are applied one at a time across the whole batch: CPython's
+        # re scans a single literal or regex much faster than an alternation of
+        # all of them, and plain strings only need each url lowercased once.
+        results = [False] * len(file_urls)
+        if self.literals:
+            lowered_file_urls = [file_url.lower() for file_url in file_urls]
+            for literal in self.literals:
+                results = [result or literal in file_url for result, file_url in zip(results, lowered_file_urls)]
+        for regex in self.regexes:
+            search = regex.search
+            results = [result or search(file_url) is not None for result, file_url in zip(results, file_urls)]
+        return results
@@ -1,29 +1,86 @@
 import os
-import re
 import sys
+import contextlib
+import csv
 import json
-import queue
+import time
+import shutil
 import threading
+import urllib.error
 import urllib.parse
 import urllib.request
-from collections import OrderedDict
+from array import array
+from itertools import islice
+from pathlib import Path
+from threading import Lock
+from urllib.parse import unquote_to_bytes
 
-class WaybackMachineDownloader:
+from archive_api import ArchiveAPI
+from async_downloader import AsyncDownloadEngine, ContentRangeError
+from content_store import ContentStore
+from download_journal import DownloadJournal
+from download_manifest import DownloadManifest
+from download_plan import DownloadPlan
+from download_shards import ShardVerifier, parse_shard, shard_of
+from download_stats import DownloadStats, ProgressReporter
+from request_scheduler import RequestScheduler
+from snapshot_store import CuratedFileList, FileRecord, newest_per_file
+from tidy_bytes import tidy_bytes
+from url_filter import UrlFilter
+from work_queue import WorkQueue
+from snapshot_index import SnapshotIndex
+
+class WaybackMachineDownloader(ArchiveAPI):
 
     VERSION = "2.3.1"
+    CHUNK_SIZE = 2 ** 16
+    FILTER_BATCH_SIZE = 10000
+    LIST_FIELDS = ('file_url', 'timestamp', 'file_id')
 
     def __init__(self, params):
         self.base_url = params.get('base_url')
         self.exact_url = params.get('exact_url')
         self.directory = params.get('directory')
         self.all_timestamps = params.get('all_timestamps')
-        self.from_timestamp = int(params.get('from_timestamp', 0))
-        self.to_timestamp = int(params.get('to_timestamp', 0))
+        self.from_timestamp = int(params.get('from_timestamp') or 0)
+        self.to_timestamp = int(params.get('to_timestamp') or 0)
         self.only_filter = params.get('only_filter')
         self.exclude_filter = params.get('exclude_filter')
+        self.only_url_filter = UrlFilter(self.only_filter)
+        self.exclude_url_filter = UrlFilter(self.exclude_filter)
         self.all = params.get('all')
-        self.maximum_pages = int(params.get('maximum_pages', 100))
-        self.threads_count = int(params.get('threads_count', 1))
+        self.maximum_pages = int(params.get('maximum_pages') or 100)
+        self.threads_count = int(params.get('threads_count') or 1)
+        self.cdx_concurrency = int(params.get('cdx_concurrency') or 4)
+        self.verbose = params.get('verbose')
+        self.list_format = params.get('list_format') or 'json'
+        self.engine = params.get('engine') or 'threads'
+        self.archive_url = params.get('archive_url') or self.ARCHIVE_URL
+        self.stats = DownloadStats()
+        self.stats_path = params.get('stats')
+        self.progress_interval = float(params.get('progress_interval') or 0)
+        self.scheduler = RequestScheduler(max(self.threads_count, self.cdx_concurrency),
+                                          rate_limit=params.get('rate_limit'),
+                                          retries=int(params.get('retries') if params.get('retries') is not None else 5),
+                                          stats=self.stats)
+        self.snapshot_index = params.get('snapshot_index')
+        self.server_collapse = params.get('server_collapse')
+        self.deduplicate = params.get('deduplicate')
+        self.content_store = None
+        self.shard_index, self.shards_count = parse_shard(params['shard']) if params.get('shard') else (0, 1)
+        # Each shard keeps its own journal for the merge step
+        self.use_journal = params.get('journal') or self.shards_count > 1
+        self.refresh = params.get('refresh')
+        self.stale_action = params.get('stale') or 'archive'
+        self.manifest = None
+        if self.refresh and self.shards_count > 1:
+            raise ValueError("refreshing a backup can't be combined with shards")
+        if self.snapshot_index and self.shards_count > 1:
+            # Every shard would write the same shared sqlite index at once
+            raise ValueError("a snapshot index can't be combined with shards")
+        self.journal = None
+        self.last_indexed_timestamp = None
+        self.listing_complete = True
 
     def backup_name(self):
         if '//' in self.base_url:
@@ -40,108 +97,219 @@ class WaybackMachineDownloader:
         else:
             return 'websites/' + self.backup_name() + '/'
 
+    def state_path(self):
+        return Path(self.backup_path()) / '.wayback'
+
     def match_only_filter(self, file_url):
-        if self.only_filter:
-            only_filter_regex = self.only_filter
-            if only_filter_regex:
-                return bool(re.search(only_filter_regex, file_url))
-            else:
-                return self.only_filter.lower() in file_url.lower()
+        if self.only_url_filter:
+            return self.only_url_filter.match(file_url)
         else:
             return True
 
     def match_exclude_filter(self, file_url):
-        if self.exclude_filter:
-            exclude_filter_regex = self.exclude_filter
-            if exclude_filter_regex:
-                return bool(re.search(exclude_filter_regex, file_url))
-            else:
-                return self.exclude_filter.lower() in file_url.lower()
+        return self.exclude_url_filter.match(file_url)
+
+    def get_snapshots_matching_filters(self):
+        snapshots = iter(self.get_all_snapshots_to_consider())
+        while snapshot_batch := list(islice(snapshots, self.FILTER_BATCH_SIZE)):
+            snapshot_batch = [snapshot for snapshot in snapshot_batch if '/' in snapshot[1]]
+            file_urls = [snapshot[1] for snapshot in snapshot_batch]
+            with self.stats.phase('filtering'):
+                excluded = self.exclude_url_filter.match_batch(file_urls)
+                included = self.only_url_filter.match_batch(file_urls) if self.only_url_filter else [True] * len(file_urls)
+            for snapshot, is_excluded, is_included in zip(snapshot_batch, excluded, included):
+                if is_excluded:
+                    print(f"File url matches exclude filter, ignoring: {snapshot[1]}")
+                elif not is_included:
+                    print(f"File url doesn't match only filter, ignoring: {snapshot[1]}")
+                else:
+                    yield snapshot
+
+    def get_all_snapshots_to_consider(self):
+        if not self.snapshot_index:
+            yield from self.get_snapshots_from_api()
+            return
+
+        self.last_indexed_timestamp = None
+        with SnapshotIndex(self.state_path() / 'snapshots.sqlite', self.snapshot_index_key()) as index:
+            self.last_indexed_timestamp = index.last_timestamp
+            # Rows stored by earlier runs first, then the newer ones as the
+            # CDX API returns them
+            yield from index.snapshots()
+            yield from index.add(self.get_snapshots_from_api())
+            if self.listing_complete:
+                index.advance()
+            print(f"{index.count()} snapshots in local index.")
+
+    def snapshot_index_key(self):
+        return json.dumps([self.base_url, bool(self.exact_url), self.parameters_for_api(None)])
+
+    def get_snapshots_from_api(self):
+        # Note: Passing a page index parameter allow us to get more snapshots,
+        # but from a less fresh index
+        print("Getting snapshot pages", end="", flush=True)
+        self.listing_complete = True
+        snapshot_count = 0
+        for snapshot in self.get_raw_list_from_api(self.base_url, None):
+            snapshot_count += 1
+            yield snapshot
+        print(".", end="", flush=True)
+        if not self.exact_url:
+            for snapshot_list in self.iter_snapshot_pages(self.base_url + '/*'):
+                snapshot_count += len(snapshot_list)
+                yield from snapshot_list
+                print(".", end="", flush=True)
+        print(f" found {snapshot_count} snaphots to consider.")
+        print()
+
+    def iter_snapshot_pages(self, url):
+        pages_count = self.get_pages_count(url)
+        if pages_count is not None:
+            if pages_count > self.maximum_pages:
+                self.listing_complete = False
+            yield from self.iter_pages_from_api(url, min(pages_count, self.maximum_pages))
+            return
+        for page_index in range(self.maximum_pages):
+            snapshot_list = self.get_raw_list_from_api(url, page_index)
+            if not snapshot_list:
+                break
+            yield snapshot_list
         else:
-            return False
+            self.listing_complete = False
 
-    def get_file_list_curated(self):
-        file_list_curated = {}
-        for file_timestamp, file_url in self.get_all_snapshots_to_consider():
-            if '/' not in file_url:
-                continue
+    def keeps_digests(self):
+        return self.deduplicate or self.refresh
+
+    def snapshot_details(self, fields, keeps_digests):
+        # Digest and length columns following timestamp and original
+        digest = fields[0] if keeps_digests and fields else None
+        length = int(fields[1]) if len(fields) > 1 and fields[1].isdigit() else 0
+        return digest, length
+
+    def get_file_snapshots(self):
+        keeps_digests = self.keeps_digests()
+        for file_timestamp, file_url, *fields in self.get_snapshots_matching_filters():
+            digest, length = self.snapshot_details(fields, keeps_digests)
             file_id = '/'.join(file_url.split('/')[3:])
-            file_id = urllib.unquote(file_id)
-            file_id = file_id.encode('utf-8', 'ignore').decode('utf-8') if file_id != "" else file_id
+            file_id = tidy_bytes(unquote_to_bytes(file_id)) if file_id != "" else file_id
             if file_id is None:
                 print(f"Malformed file url, ignoring: {file_url}")
             else:
-                if self.match_exclude_filter(file_url):
-                    print(f"File url matches exclude filter, ignoring: {file_url}")
-                elif not self.match_only_filter(file_url):
-                    print(f"File url doesn't match only filter, ignoring: {file_url}")
-                elif file_id in file_list_curated:
-                    if not file_list_curated[file_id]['timestamp'] > file_timestamp:
-                        file_list_curated[file_id] = {'file_url': file_url, 'timestamp': file_timestamp}
-                else:
-                    file_list_curated[file_id] = {'file_url': file_url, 'timestamp': file_timestamp}
+                yield file_id, file_url, file_timestamp, digest, length
+
+    def get_file_list_curated(self):
+        file_list_curated = CuratedFileList()
+        for file_id, file_url, file_timestamp, digest, length in self.get_file_snapshots():
+            file_list_curated.add_newest(file_id, file_url, file_timestamp, digest, length)
         return file_list_curated
 
-    from urllib.parse import unquote
+    def iter_file_list_curated(self):
+        # With server side collapsing the CDX rows arrive grouped by url, so
+        # each file can be emitted as soon as its group ends. Otherwise, or
+        # when a snapshot index mixes rows of several runs, the newest
+        # snapshot of a file is only known once every row was seen.
+        if self.collapse_urls() and not self.snapshot_index:
+            yield from newest_per_file(self.get_file_snapshots())
+        else:
+            yield from self.get_file_list_curated().in_order()
 
-    def get_file_list_all_timestamps(self):
-        file_list_curated = {}
-        for file_timestamp, file_url in self.get_all_snapshots_to_consider():
-            if '/' not in file_url:
-                continue
+    def get_timestamped_file_snapshots(self):
+        keeps_digests = self.keeps_digests()
+        for file_timestamp, file_url, *fields in self.get_snapshots_matching_filters():
+            digest, length = self.snapshot_details(fields, keeps_digests)
             file_id = '/'.join(file_url.split('/')[3:])
             file_id_and_timestamp = '/'.join([file_timestamp, file_id])
-            file_id_and_timestamp = unquote(file_id_and_timestamp)
-            file_id_and_timestamp = file_id_and_timestamp.encode('utf-8', 'ignore').decode('utf-8') if file_id_and_timestamp != "" else file_id_and_timestamp
+            file_id_and_timestamp = tidy_bytes(unquote_to_bytes(file_id_and_timestamp)) if file_id_and_timestamp != "" else file_id_and_timestamp
             if file_id is None:
                 print(f"Malformed file url, ignoring: {file_url}")
             else:
-                if self.match_exclude_filter(file_url):
-                    print(f"File url matches exclude filter, ignoring: {file_url}")
-                elif not self.match_only_filter(file_url):
-                    print(f"File url doesn't match only filter, ignoring: {file_url}")
-                elif file_id_and_timestamp in file_list_curated:
-                    if self.verbose:
-                        print(f"Duplicate file and timestamp combo, ignoring: {file_id}")
-                else:
-                    file_list_curated[file_id_and_timestamp] = {'file_url': file_url, 'timestamp': file_timestamp}
+                yield file_id_and_timestamp, file_url, file_timestamp, digest, length
+
+    def get_file_list_all_timestamps(self):
+        file_list_curated = CuratedFileList()
+        for file_id_and_timestamp, file_url, file_timestamp, digest, length in self.get_timestamped_file_snapshots():
+            if file_id_and_timestamp in file_list_curated:
+                if self.verbose:
+                    print(f"Duplicate file and timestamp combo, ignoring: {file_id_and_timestamp}")
+            else:
+                file_list_curated.add(file_id_and_timestamp, file_url, file_timestamp, digest, length)
         print(f"file_list_curated: {len(file_list_curated)}")
         return file_list_curated
 
+    def iter_file_list_all_timestamps(self):
+        seen = set()
+        for file_id_and_timestamp, file_url, file_timestamp, digest, length in self.get_timestamped_file_snapshots():
+            if file_id_and_timestamp in seen:
+                if self.verbose:
+                    print(f"Duplicate file and timestamp combo, ignoring: {file_id_and_timestamp}")
+            else:
+                seen.add(file_id_and_timestamp)
+                yield FileRecord(file_url, file_timestamp, file_id_and_timestamp, digest, length)
+
     def get_file_list_by_timestamp(self):
         if self.all_timestamps:
-            file_list_curated = self.get_file_list_all_timestamps()
-            return [{**file_info, 'file_id': file_id_and_timestamp} for file_id_and_timestamp, file_info in file_list_curated.items()]
+            return self.get_file_list_all_timestamps().in_order()
         else:
-            file_list_curated = self.get_file_list_curated()
-            file_list_curated = sorted(file_list_curated.items(), key=lambda x: x[1]['timestamp'], reverse=True)
-            return [{**file_info, 'file_id': file_id} for file_id, file_info in file_list_curated]
-
-    import json
-    import sys
-    import threading
-    import time
-    from pathlib import Path
-    import shutil
-
-    def list_files(self):
-        orig_stdout = sys.stdout
-        sys.stdout = sys.stderr
-        files = self.get_file_list_by_timestamp()
-        sys.stdout = orig_stdout
-        print("[")
-        for file in files[:-1]:
-            print(json.dumps(file) + ",")
-        print(json.dumps(files[-1]))
-        print("]")
+            return self.get_file_list_curated().by_timestamp()
+
+    def list_files(self, output=None):
+        # Rows are written as soon as curation yields them; progress and
+        # ignore messages go to stderr so the output stays machine readable.
+        output = output or sys.stdout
+        file_records = self.iter_file_list_all_timestamps() if self.all_timestamps else self.iter_file_list_curated()
+        with contextlib.redirect_stdout(sys.stderr):
+            if self.list_format == 'csv':
+                writer = csv.writer(output)
+                writer.writerow(self.LIST_FIELDS)
+                for file_record in file_records:
+                    writer.writerow([getattr(file_record, field) for field in self.LIST_FIELDS])
+            elif self.list_format == 'jsonl':
+                for file_record in file_records:
+                    output.write(json.dumps(file_record.to_dict()) + "\n")
+            else:
+                separator = "\n"
+                output.write("[")
+                for file_record in file_records:
+                    output.write(separator + json.dumps(file_record.to_dict()))
+                    separator = ",\n"
+                output.write("\n]\n")
+        output.flush()
 
     def download_files(self):
         start_time = time.time()
-        print(f"Downloading {self.base_url} to {self.backup_path} from Wayback Machine archives.")
+        if not self.start_download():
+            return
+        self.file_queue
+        self.stats.workers_count = self.threads_count
+        try:
+            with self.stats.phase('download'), self.progress_reporter():
+                if self.engine == 'asyncio':
+                    AsyncDownloadEngine(self, self.threads_count).run()
+                else:
+                    threads = []
+                    for worker in range(self.threads_count):
+                        thread = threading.Thread(target=self.download_file_worker, args=(worker,))
+                        thread.start()
+                        threads.append(thread)
+
+                    for thread in threads:
+                        thread.join()
+            if self.manifest:
+                self.remove_stale_files()
+        finally:
+            self.finish_download()
+
+        end_time = time.time()
+        print()
+        print(f"Download completed in {round(end_time - start_time, 2)}s, saved in {self.backup_path()} ({self.files_count()} files)")
+
+    def start_download(self):
+        # Lists the site and prepares the backup directory, returning False
+        # when there is nothing to download.
+        print(f"Downloading {self.base_url} to {self.backup_path()} from Wayback Machine archives.")
         print()
 
-        files = self.get_file_list_by_timestamp()
-        if len(files) == 0:
+        if len(self.download_plan) == 0:
             print("No files to download.")
             print("Possible reasons:")
             print("\t* Site is not in Wayback Machine Archive.")
@@ -149,31 +317,67 @@ class WaybackMachineDownloader:
             print("\t* To timestamp too much in the past." if self.to_timestamp and self.to_timestamp != 0 else "")
             print("\t* Only filter too restrictive ({self.only_filter})" if self.only_filter else "")
             print("\t* Exclude filter too wide ({self.exclude_filter})" if self.exclude_filter else "")
-            return
+            return False
 
-        print(f"{len(files)} files to download:")
+        if self.shards_count > 1:
+            print(f"{self.files_count()} of {len(self.download_plan)} files to download in shard "
+                  f"{self.shard_index + 1}/{self.shards_count}:")
+        else:
+            print(f"{len(self.download_plan)} files to download:")
 
         self.processed_file_count = 0
         self.threads_count = 1 if self.threads_count == 0 else self.threads_count
-        threads = []
-        for _ in range(self.threads_count):
-            thread = threading.Thread(target=self.download_file_worker)
-            thread.start()
-            threads.append(thread)
+        if self.use_journal:
+            self.journal = DownloadJournal(self.journal_path())
+        if self.deduplicate:
+            self.content_store = ContentStore(self.state_path() / 'objects')
+        if self.refresh:
+            self.manifest = DownloadManifest(self.state_path() / 'manifest.jsonl')
+        with self.stats.phase('directories'):
+            self.structure_backup_dirs()
+        return True
 
-        for thread in threads:
-            thread.join()
+    def finish_download(self):
+        if self.journal:
+            self.journal.close()
+            self.journal = None
+        if self.manifest:
+            self.manifest.close()
+            self.manifest = None
+        if self.stats_path:
+            self.stats.write(self.stats_path)
 
-        end_time = time.time()
-        print()
-        print(f"Download completed in {round(end_time - start_time, 2)}s, saved in {self.backup_path} ({len(files)} files)")
+    def progress_reporter(self):
+        # Queue depth is only sampled while a reporter runs, so one runs
+        # quietly whenever a stats report was asked for.
+        if self.progress_interval:
+            return ProgressReporter(self, self.progress_interval)
+        if self.stats_path:
+            return ProgressReporter(self, 1.0, printing=False)
+        return contextlib.nullcontext()
+
+    def structure_backup_dirs(self):
+        # The whole tree is created before any worker starts, parents first,
+        # so downloads only open and write files.
+        backup_path = Path(self.backup_path())
+        backup_path.mkdir(parents=True, exist_ok=True)
+        for directory in sorted(self.download_plan.directories):
+            dir_path = backup_path / directory
+            try:
+                os.mkdir(dir_path)
+            except FileExistsError:
+                if not dir_path.is_dir():
+                    # Left as a file by an earlier run
+                    self.structure_dir_path(dir_path)
+            except OSError as e:
+                print(f"{dir_path} # {e}")
 
     def structure_dir_path(self, dir_path):
         try:
-            dir_path.mkdir(parents=True, exist_ok=False)
-        except FileExistsError as e:
-            file_already_existing = Path(str(e).split("File exists: ")[-1].strip("'"))
-            file_already_existing_temporary = file_already_existing.with_suffix('.temp')
+            dir_path.mkdir(parents=True, exist_ok=True)
+        except (FileExistsError, NotADirectoryError):
+            file_already_existing = next(path for path in (dir_path, *dir_path.parents) if path.is_file())
+            file_already_existing_temporary = file_already_existing.with_name(file_already_existing.name + '.temp')
             file_already_existing_permanent = file_already_existing / 'index.html'
             shutil.move(str(file_already_existing), str(file_already_existing_temporary))
             file_already_existing.mkdir()
@@ -181,73 +385,278 @@ class WaybackMachineDownloader:
             print(f"{file_already_existing} -> {file_already_existing_permanent}")
             self.structure_dir_path(dir_path)
 
-    import urllib.request
-    from queue import Queue
-    from threading import Lock
-
-    def download_file(self, file_remote_info):
-        current_encoding = "utf-8"
-        file_url = file_remote_info["file_url"].encode(current_encoding).decode("utf-8")
-        file_id = file_remote_info["file_id"]
-        file_timestamp = file_remote_info["timestamp"]
-        file_path_elements = file_id.split('/')
-
-        if file_id == "":
-            dir_path = self.backup_path
-            file_path = self.backup_path / 'index.html'
-        elif file_url[-1] == '/' or '.' not in file_path_elements[-1]:
-            dir_path = self.backup_path.joinpath(*file_path_elements[:-1])
-            file_path = dir_path / 'index.html'
-        else:
-            dir_path = self.backup_path.joinpath(*file_path_elements[:-1])
-            file_path = self.backup_path.joinpath(*file_path_elements)
+    def download_file(self, planned_file):
+        file_url = planned_file.file_url
+        file_path = planned_file.file_path
 
-        if not file_path.exists():
-            try:
-                self.structure_dir_path(dir_path)
-                with file_path.open("wb") as file:
-                    try:
-                        with urllib.request.urlopen(f"https://web.archive.org/web/{file_timestamp}id_/{file_url}") as uri:
-                            file.write(uri.read())
-                    except urllib.error.HTTPError as e:
-                        print(f"{file_url} # {e}")
-                        if self.all:
-                            file.write(e.read())
-                            print(f"{file_path} saved anyway.")
-                    except Exception as e:
-                        print(f"{file_url} # {e}")
-            except Exception as e:
+        if self.already_downloaded(planned_file):
+            self.stats.count('files_existing')
+            self.count_processed_file(f"{file_url} # {file_path} {'is up to date' if self.manifest else 'already exists'}.")
+            return
+        if self.link_stored_file(planned_file):
+            self.stats.count('files_linked')
+            self.count_processed_file(f"{file_url} -> {file_path} (linked)")
+            return
+
+        part_path = self.part_path(file_path)
+        offset = self.start_file(planned_file, part_path)
+        status = None
+        complete = False
+        try:
+            status = self.scheduler.call(lambda: self.fetch_file(planned_file, part_path), file_url)
+            complete = True
+        except urllib.error.HTTPError as e:
+            status = e.code
+            if status == 416 and offset:
+                # The previous run already received the whole body
+                complete = True
+            else:
                 print(f"{file_url} # {e}")
-            finally:
-                if not self.all and file_path.exists() and file_path.stat().st_size == 0:
-                    file_path.unlink()
-                    print(f"{file_path} was empty and was removed.")
+                if self.all:
+                    with part_path.open("wb") as file:
+                        self.write_stream(e, file)
+                    print(f"{file_path} saved anyway.")
+                    complete = True
+        except Exception as e:
+            print(f"{file_url} # {e}")
+        finally:
+            self.finish_file(planned_file, part_path, complete, status)
+        self.count_processed_file(f"{file_url} -> {file_path}")
+
+    def fetch_file(self, planned_file, part_path):
+        start = time.perf_counter()
+        offset = part_path.stat().st_size if part_path.exists() else 0
+        request = urllib.request.Request(self.snapshot_url(planned_file), headers=self.range_headers(offset))
+        with urllib.request.urlopen(request, timeout=self.scheduler.timeout) as uri:
+            with self.open_part(part_path, uri.status, offset, uri.headers.get('Content-Range')) as file:
+                self.write_stream(uri, file)
+            self.record_fetch(start, part_path, offset, uri.status)
+            return uri.status
+
+    def record_fetch(self, start, part_path, offset, status):
+        size = part_path.stat().st_size - (offset if status == 206 else 0) if part_path.exists() else 0
+        self.stats.request('snapshot', time.perf_counter() - start, status, size)
+
+    def already_downloaded(self, planned_file):
+        if self.manifest:
+            # Refreshing: an existing file counts only if it holds this snapshot
+            if not (self.manifest.is_current(planned_file) and planned_file.file_path.exists()):
+                return False
+            if not self.manifest.is_recorded(planned_file):
+                self.record_manifest(planned_file)
+            return True
+        if self.journal and self.journal.is_done(planned_file.file_id):
+            return True
+        if planned_file.file_path.exists():
+            if self.journal:
+                self.journal.record(planned_file, DownloadJournal.DONE, bytes=planned_file.file_path.stat().st_size)
+            return True
+        return False
+
+    def link_stored_file(self, planned_file):
+        # Snapshots whose digest was already downloaded are linked to the
+        # stored body instead of being fetched again. The link is made next to
+        # its destination, which a refresh may already hold an old version of.
+        if not (self.content_store and self.content_store.has(planned_file.digest)):
+            return False
+        link_path = planned_file.file_path.with_name(planned_file.file_path.name + '.link')
+        try:
+            link_path.unlink(missing_ok=True)
+            self.content_store.link(planned_file.digest, link_path)
+            self.replace_file(link_path, planned_file.file_path)
+        except OSError as e:
+            print(f"{planned_file.file_url} # {e}")
+            return False
+        if self.journal:
+            self.journal.record(planned_file, DownloadJournal.DONE, bytes=planned_file.file_path.stat().st_size,
+                                digest=planned_file.digest)
+        self.record_manifest(planned_file)
+        return True
+
+    def start_file(self, planned_file, part_path):
+        # A .part file left by an interrupted run is resumed from where it
+        # stopped when the archive honours the Range header, but only if the
+        # journal or manifest shows it came from the same snapshot.
+        records = [record for record in (self.manifest, self.journal) if record]
+        if part_path.exists() and not (records and all(record.resumable(planned_file) for record in records)):
+            part_path.unlink()
+        if self.manifest:
+            # The old version, if any, stays at path until the new one is complete
+            self.manifest.record(planned_file, DownloadManifest.IN_PROGRESS, path=self.relative_path(planned_file))
+        offset = part_path.stat().st_size if part_path.exists() else 0
+        if self.journal:
+            self.journal.record(planned_file, DownloadJournal.IN_PROGRESS, bytes=offset)
+        return offset
+
+    @staticmethod
+    def range_headers(offset):
+        return {'Range': f"bytes={offset}-"} if offset else {}
+
+    @staticmethod
+    def open_part(part_path, status, offset, content_range=None):
+        if not (offset and status == 206):
+            return part_path.open("wb")
+        # "bytes 1000-1999/2000"
+        start = (content_range or '').partition(' ')[2].partition('-')[0]
+        if start != str(offset):
+            part_path.unlink()
+            raise ContentRangeError(f"Partial content starts at {start or 'an unknown offset'}, expected {offset}")
+        return part_path.open("ab")
+
+    def write_stream(self, source, file):
+        buffer = bytearray(self.CHUNK_SIZE)
+        view = memoryview(buffer)
+        while size := source.readinto(buffer):
+            file.write(view[:size])
+
+    @staticmethod
+    def part_path(file_path):
+        return file_path.with_name(file_path.name + '.part')
+
+    def finish_file(self, planned_file, part_path, complete, status=None):
+        # Bodies are written next to their destination and only renamed into
+        # place once complete, so an existing file_path is always a whole file.
+        # Incomplete bodies are kept for the next run to resume.
+        file_path = planned_file.file_path
+        size = part_path.stat().st_size if part_path.exists() else 0
+        if complete and part_path.exists() and (self.all or size > 0):
+            self.replace_file(part_path, file_path)
+            state = DownloadJournal.DONE
+            self.record_manifest(planned_file)
+            if self.content_store and status in (200, 206, 416):
+                self.content_store.add(planned_file.digest, file_path)
         else:
-            with self.semaphore:
-                self.processed_file_count += 1
-                print(f"{file_url} # {file_path} already exists. ({self.processed_file_count}/{len(self.get_file_list_by_timestamp())})")
+            if part_path.exists() and (complete or size == 0):
+                part_path.unlink()
+                if complete:
+                    print(f"{file_path} was empty and was removed.")
+            state = DownloadJournal.FAILED
+        self.stats.count('files_done' if state == DownloadJournal.DONE else 'files_failed')
+        if self.journal:
+            self.journal.record(planned_file, state, bytes=size, status=status)
 
-    def download_file_worker(self):
-        while True:
-            try:
-                file_remote_info = self.file_queue.get_nowait()
-            except Exception:
-                break
-            self.download_file(file_remote_info)
+    def replace_file(self, source_path, file_path):
+        # A refresh archives the version being replaced unless told otherwise
+        if self.manifest and self.stale_action == 'archive' and file_path.is_file():
+            self.archive_stale_file(file_path)
+        os.replace(source_path, file_path)
+
+    def relative_path(self, planned_file):
+        return planned_file.file_path.relative_to(self.backup_path()).as_posix()
+
+    def record_manifest(self, planned_file):
+        if self.manifest:
+            self.manifest.record(planned_file, DownloadManifest.DONE, digest=planned_file.digest,
+                                 path=self.relative_path(planned_file))
+
+    def remove_stale_files(self):
+        # Files of an earlier run whose file id is no longer listed, among
+        # those this listing covers
+        if not self.listing_complete:
+            print("The snapshot listing was incomplete, no file is treated as stale.")
+            return
+        current_file_ids = {file_record.file_id for file_record in self.download_plan.file_list}
+        stale_file_ids = [file_id for file_id, entry in self.manifest.entries.items()
+                          if file_id not in current_file_ids and self.in_listing_scope(entry)]
+        for file_id in stale_file_ids:
+            entry = self.manifest.entries[file_id]
+            file_path = Path(self.backup_path()) / entry['path'] if entry.get('path') else None
+            if file_path and file_path.is_file() and self.stale_action != 'keep':
+                if self.stale_action == 'archive':
+                    self.archive_stale_file(file_path)
+                else:
+                    file_path.unlink()
+                print(f"{file_path} is no longer listed and was {self.stale_action}d.")
+            self.manifest.remove(file_id)
+        if stale_file_ids:
+            print(f"{len(stale_file_ids)} stale files {'kept' if self.stale_action == 'keep' else self.stale_action + 'd'}.")
+
+    def in_listing_scope(self, entry):
+        # Whether the filters and time window of this run would have listed
+        # the entry's snapshot, had it still been in the archive
+        if self.exact_url:
+            return False
+        timestamp = entry['timestamp']
+        if self.from_timestamp and timestamp < str(self.from_timestamp).ljust(14, '0'):
+            return False
+        if self.to_timestamp and timestamp > str(self.to_timestamp).ljust(14, '9'):
+            return False
+        return self.match_only_filter(entry['file_url']) and not self.match_exclude_filter(entry['file_url'])
+
+    def archive_stale_file(self, file_path):
+        archive_path = self.stale_path() / file_path.relative_to(self.backup_path())
+        archive_path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(file_path, archive_path)
+
+    def stale_path(self):
+        # One folder per refresh, made unique when several start in the same second
+        with self.semaphore:
+            if not hasattr(self, "_stale_path"):
+                stale_name = time.strftime('%Y%m%d%H%M%S')
+                stale_path = self.state_path() / 'stale' / stale_name
+                attempt = 1
+                while True:
+                    try:
+                        stale_path.mkdir(parents=True)
+                        break
+                    except FileExistsError:
+                        attempt += 1
+                        stale_path = stale_path.with_name(f"{stale_name}-{attempt}")
+                self._stale_path = stale_path
+            return self._stale_path
+
+    def count_processed_file(self, message):
+        with self.semaphore:
+            self.processed_file_count += 1
+            print(f"{message} ({self.processed_file_count}/{self.files_count()})")
+
+    def download_file_worker(self, worker=0):
+        while (file_index := self.file_queue.get(worker)) is not None:
+            start = time.perf_counter()
+            self.download_file(self.download_plan[file_index])
+            self.stats.worker_busy(worker, time.perf_counter() - start)
 
     @property
     def file_queue(self):
         if not hasattr(self, "_file_queue"):
-            self._file_queue = Queue()
-            for file_info in self.get_file_list_by_timestamp():
-                self._file_queue.put(file_info)
+            self._file_queue = WorkQueue(self.threads_count).fill(self.download_plan.file_list, self.shard_indexes)
         return self._file_queue
 
     @property
-    def file_list_by_timestamp(self):
-        if not hasattr(self, "_file_list_by_timestamp"):
-            self._file_list_by_timestamp = self.get_file_list_by_timestamp()
-        return self._file_list_by_timestamp
+    def shard_indexes(self):
+        # Plan indexes this process downloads, or None for the whole plan.
+        # Directories are still planned from every file so all shards agree
+        # on the tree.
+        if self.shards_count == 1:
+            return None
+        if not hasattr(self, "_shard_indexes"):
+            file_list = self.download_plan.file_list
+            self._shard_indexes = array('L', (index for index in range(len(file_list))
+                                              if shard_of(file_list[index].file_id, self.shards_count) == self.shard_index))
+        return self._shard_indexes
+
+    def files_count(self):
+        return len(self.download_plan) if self.shard_indexes is None else len(self.shard_indexes)
+
+    def journal_path(self):
+        if self.shards_count > 1:
+            return self.state_path() / f"journal-{self.shard_index + 1}-of-{self.shards_count}.jsonl"
+        return self.state_path() / 'journal.jsonl'
+
+    def verify_shards(self):
+        print(f"Verifying {self.backup_path()} against the journals of every shard.")
+        results = ShardVerifier(self).verify()
+        print()
+        print(", ".join(f"{count} {result}" for result, count in sorted(results.items())) +
+              f" ({len(self.download_plan)} files)")
+        return set(results) <= {'ok'}
+
+    @property
+    def download_plan(self):
+        if not hasattr(self, "_download_plan"):
+            with self.stats.phase('planning'):
+                self._download_plan = DownloadPlan(self.backup_path(), self.get_file_list_by_timestamp())
+        return self._download_plan
 
     @property
     def semaphore(self):
@@ -0,0 +1,241 @@
+import base64
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-in for the Wayback Machine, serving the CDX API and the
+# /web/{timestamp}id_/{url} endpoint from an in-memory list of snapshots,
+# with optional latency, bandwidth limit and injected 503 errors.
+
+class WaybackStubServer(ThreadingHTTPServer):
+
+    # The socketserver default backlog of 5 makes a few dozen concurrent
+    # connects stall on SYN retransmits, measuring the kernel rather than
+    # the downloader.
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+class WaybackStubHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    SNAPSHOT_PATH = re.compile(r'^/web/(\d+)id_/(.*)$')
+    RANGE = re.compile(r'^bytes=(\d+)-$')
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        stub = self.server.stub
+        if stub.latency:
+            time.sleep(stub.latency)
+        if stub.fails():
+            stub.request_counts['errors'] += 1
+            self.send_body(503, b'Service Unavailable')
+            return
+        parsed_path = urllib.parse.urlsplit(self.path)
+        if parsed_path.path == '/cdx/search/xd':
+            self.server.stub.request_counts['cdx'] += 1
+            self.send_cdx(dict(urllib.parse.parse_qsl(parsed_path.query)))
+        elif match := self.SNAPSHOT_PATH.match(urllib.parse.unquote(parsed_path.path)):
+            self.server.stub.request_counts['web'] += 1
+            file_url = match.group(2) + ('?' + parsed_path.query if parsed_path.query else '')
+            self.send_snapshot(match.group(1), file_url)
+        else:
+            self.send_body(404, b'Not Found')
+
+    def send_body(self, status, body, headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        bandwidth = self.server.stub.bandwidth
+        if not bandwidth:
+            self.wfile.write(body)
+            return
+        # Paced in tenths of a second worth of bytes
+        chunk_size = max(1, int(bandwidth / 10))
+        for offset in range(0, len(body), chunk_size):
+            chunk = body[offset:offset + chunk_size]
+            self.wfile.write(chunk)
+            time.sleep(len(chunk) / bandwidth)
+
+    def send_cdx(self, query):
+        stub = self.server.stub
+        snapshots = stub.query(query.get('url', ''), query.get('from'), query.get('to'))
+        if query.get('showNumPages'):
+            self.send_body(200, str(stub.pages_count(len(snapshots))).encode())
+            return
+        if 'page' in query:
+            page_index = int(query['page'])
+            snapshots = snapshots[page_index * stub.page_size:(page_index + 1) * stub.page_size]
+        fields = query.get('fl', 'timestamp,original').split(',')
+        rows = [[getattr(snapshot, field) for field in fields] for snapshot in snapshots]
+        if query.get('collapse') == 'urlkey':
+            fields, rows = self.collapse_urlkey(fields, snapshots, query)
+        rows = [fields] + rows if rows else []
+        self.send_body(200, ('[' + ',\n'.join(json.dumps(row) for row in rows) + ']\n').encode(),
+                       [("Content-Type", "text/plain")])
+
+    @staticmethod
+    def collapse_urlkey(fields, snapshots, query):
+        groups = {}
+        for snapshot in snapshots:
+            groups.setdefault(snapshot.urlkey, []).append(snapshot)
+        rows = []
+        for group in groups.values():
+            rows.append([getattr(group[0], field) for field in fields])
+            if query.get('showSkipCount'):
+                rows[-1].append(str(len(group) - 1))
+            if query.get('lastSkipTimestamp'):
+                rows[-1].append(group[-1].timestamp if len(group) > 1 else '-')
+        if query.get('showSkipCount'):
+            fields = fields + ['skipcount']
+        if query.get('lastSkipTimestamp'):
+            fields = fields + ['endtimestamp']
+        return fields, rows
+
+    def send_snapshot(self, timestamp, file_url):
+        snapshot = self.server.stub.snapshot(timestamp, file_url)
+        if snapshot is None:
+            self.send_body(404, b'Not Found')
+        elif snapshot.timestamp != timestamp:
+            location = f"/web/{snapshot.timestamp}id_/{snapshot.original}"
+            self.send_body(302, b'', [("Location", location)])
+        elif (match := self.RANGE.match(self.headers.get('Range', ''))) and snapshot.statuscode == 200:
+            body = snapshot.body
+            offset = int(match.group(1))
+            if offset >= len(body):
+                self.send_body(416, b'', [("Content-Range", f"bytes */{len(body)}")])
+            else:
+                self.send_body(206, body[offset:], [("Content-Range", f"bytes {offset}-{len(body) - 1}/{len(body)}")])
+        else:
+            self.send_body(snapshot.statuscode, snapshot.body)
+
+
+class StubSnapshot:
+
+    # Slotted so that sites with a million snapshots fit in memory; the
+    # attribute names double as CDX field names.
+
+    __slots__ = ('timestamp', 'original', 'body', 'statuscode', 'length', 'digest', 'urlkey')
+
+    def __init__(self, timestamp, original, body, statuscode, length, digest, urlkey):
+        self.timestamp = timestamp
+        self.original = original
+        self.body = body
+        self.statuscode = statuscode
+        self.length = length
+        self.digest = digest
+        self.urlkey = urlkey
+
+
+class WaybackStub:
+
+    MAXIMUM_CACHED_QUERIES = 16
+
+    def __init__(self, snapshots, page_size=1000, host='127.0.0.1', port=0, latency=0.0, bandwidth=None,
+                 error_rate=0.0, seed=None):
+        self.body_details = {}
+        self.snapshots = sorted((self.snapshot_record(*snapshot) for snapshot in snapshots),
+                                key=lambda snapshot: (snapshot.urlkey, snapshot.timestamp))
+        self.body_details = None
+        self.snapshots_by_original = {}
+        for snapshot in self.snapshots:
+            self.snapshots_by_original.setdefault(snapshot.original, []).append(snapshot)
+        self.page_size = page_size
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.queries = {}
+        self.request_counts = Counter()
+        self.server = WaybackStubServer((host, port), WaybackStubHandler)
+        self.server.stub = self
+
+    def snapshot_record(self, timestamp, original, body, statuscode=200):
+        # Length and digest are computed once per distinct body object, as
+        # synthetic sites reuse a small pool of bodies.
+        details = self.body_details.get(body)
+        if details is None:
+            details = self.body_details[body] = (str(len(body)), base64.b32encode(hashlib.sha1(body).digest()).decode())
+        return StubSnapshot(str(timestamp), original, body, statuscode, *details, self.urlkey(original))
+
+    def fails(self):
+        if not self.error_rate:
+            return False
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    @staticmethod
+    def urlkey(original):
+        host, _, path = original.split('//', 1)[-1].partition('/')
+        host = host.split(':')[0].lower()
+        return (host[4:] if host.startswith('www.') else host) + ')/' + path.lower()
+
+    def pages_count(self, snapshots_count):
+        return max(1, -(-snapshots_count // self.page_size))
+
+    def query(self, url, from_timestamp=None, to_timestamp=None):
+        # Every page of a listing asks the same query, so results are cached
+        key = (url, from_timestamp, to_timestamp)
+        with self.lock:
+            snapshots = self.queries.get(key)
+        if snapshots is None:
+            snapshots = self.select(url, from_timestamp, to_timestamp)
+            with self.lock:
+                if len(self.queries) >= self.MAXIMUM_CACHED_QUERIES:
+                    self.queries.clear()
+                self.queries[key] = snapshots
+        return snapshots
+
+    def select(self, url, from_timestamp, to_timestamp):
+        url = url.split('//', 1)[-1]
+        prefix = url.endswith('/*')
+        url = url[:-2] if prefix else url.rstrip('/')
+        snapshots = []
+        for snapshot in self.snapshots:
+            original = snapshot.original.split('//', 1)[-1]
+            if not (original.startswith(url) if prefix else original.rstrip('/') == url):
+                continue
+            if from_timestamp and snapshot.timestamp < from_timestamp.ljust(14, '0'):
+                continue
+            if to_timestamp and snapshot.timestamp > to_timestamp.ljust(14, '9'):
+                continue
+            snapshots.append(snapshot)
+        return snapshots
+
+    def snapshot(self, timestamp, file_url):
+        candidates = self.snapshots_by_original.get(file_url, [])
+        earlier = [snapshot for snapshot in candidates if snapshot.timestamp <= timestamp]
+        if earlier:
+            return earlier[-1]
+        return candidates[0] if candidates else None
@@ -0,0 +1,92 @@
+import threading
+from collections import OrderedDict, deque
+
+class WorkQueue:
+
+    # Files are spread over one shard per worker. Each shard keeps a deque per
+    # (priority class, host), and hosts take turns within a class so one
+    # subdomain cannot starve the others. A worker serves its own shard first
+    # and steals from the fullest other shard before moving on to a lower
+    # priority class, so small pages are never stuck behind large media.
+
+    PAGES, ASSETS, LARGE = range(3)
+    PAGE_EXTENSIONS = {'', 'htm', 'html', 'xhtml', 'shtml', 'php', 'asp', 'aspx', 'jsp', 'cgi', 'css', 'js'}
+    LARGE_EXTENSIONS = {'7z', 'avi', 'bz2', 'dmg', 'exe', 'flac', 'flv', 'gz', 'iso', 'm4a', 'm4v', 'mkv', 'mov',
+                        'mp3', 'mp4', 'mpeg', 'mpg', 'ogg', 'pdf', 'rar', 'swf', 'tar', 'tgz', 'wav', 'webm', 'wmv',
+                        'xz', 'zip'}
+    LARGE_FILE_SIZE = 2 ** 20
+
+    def __init__(self, workers_count):
+        self.shards = [[OrderedDict() for _ in range(self.LARGE + 1)] for _ in range(max(1, workers_count))]
+        self.locks = [threading.Lock() for _ in self.shards]
+        self.sizes = [0] * len(self.shards)
+        self.put_count = 0
+
+    def __len__(self):
+        return sum(self.sizes)
+
+    @classmethod
+    def priority(cls, file_record):
+        # CDX lengths are the compressed size of the capture, good enough to
+        # tell a page from a video; the extension covers unknown lengths.
+        if file_record.length > cls.LARGE_FILE_SIZE:
+            return cls.LARGE
+        last_element = file_record.file_id.rstrip('/').rsplit('/', 1)[-1]
+        extension = last_element.rsplit('.', 1)[-1].lower() if '.' in last_element else ''
+        extension = extension.split('?', 1)[0]
+        if extension in cls.PAGE_EXTENSIONS:
+            return cls.PAGES
+        if extension in cls.LARGE_EXTENSIONS:
+            return cls.LARGE
+        return cls.ASSETS
+
+    @staticmethod
+    def host(file_url):
+        elements = file_url.split('/', 3)
+        return elements[2].lower() if len(elements) > 2 else ''
+
+    def put(self, item, host='', priority=ASSETS):
+        shard_index = self.put_count % len(self.shards)
+        self.put_count += 1
+        with self.locks[shard_index]:
+            hosts = self.shards[shard_index][priority]
+            items = hosts.get(host)
+            if items is None:
+                items = hosts[host] = deque()
+            items.append(item)
+            self.sizes[shard_index] += 1
+
+    def fill(self, file_list, indexes=None):
+        for index in range(len(file_list)) if indexes is None else indexes:
+            file_record = file_list[index]
+            self.put(index, self.host(file_record.file_url), self.priority(file_record))
+        return self
+
+    def get(self, worker=0):
+        # Returns None once every shard is empty
+        own_shard = worker % len(self.shards)
+        for priority in range(self.LARGE + 1):
+            item = self.take(own_shard, priority, steal=False)
+            if item is not None:
+                return item
+            for shard_index in sorted(range(len(self.shards)), key=self.sizes.__getitem__, reverse=True):
+                if shard_index != own_shard:
+                    item = self.take(shard_index, priority, steal=True)
+                    if item is not None:
+                        return item
+        return None
+
+    def take(self, shard_index, priority, steal):
+        with self.locks[shard_index]:
+            hosts = self.shards[shard_index][priority]
+            if not hosts:
+                return None
+            host, items = next(iter(hosts.items()))
+            # Owners work from the front in plan order, thieves from the back
+            item = items.pop() if steal else items.popleft()
+            if items:
+                hosts.move_to_end(host)
+            else:
+                del hosts[host]
+            self.sizes[shard_index] -= 1
+            return item